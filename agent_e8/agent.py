@@ -4,6 +4,7 @@ import asyncio
 import yaml
 from core.loop import AgentLoop
 from core.session import MultiMCP
+from modules.warmup import ollama_warmup
 import warnings
 import os
 
@@ -31,10 +32,16 @@ async def main():
 
     print("interaction_channel:", interaction_channel)
 
+    # 🔥 Preload local Ollama models while the MCP servers are being scanned
+    warmup_task = asyncio.create_task(asyncio.to_thread(ollama_warmup.warmup))
+
     multi_mcp = MultiMCP(server_configs=mcp_servers)
     print("Agent before initialize")
     await multi_mcp.initialize()
 
+    await warmup_task
+    print("Model status:", ollama_warmup.status())
+
     print("🧠 Cortex-R Agent is now ready to go and is listening for messages from the user at:", interaction_channel)
 
     while True:
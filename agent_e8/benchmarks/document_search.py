@@ -0,0 +1,82 @@
+# benchmarks/document_search.py → Document Search Benchmark
+# Role: Latency and recall of search_documents' retrieval modes on the indexed documents.
+
+# Runs labelled queries (exact terms: IDs, names, phrases; and descriptive questions)
+# through mcp_server_2.retrieve_chunks in vector, keyword and hybrid mode and reports
+# recall@k (an expected document among the top k), MRR and retrieval latency.
+# Query embeddings are computed once up front, so latencies are retrieval only.
+
+# Needs the MCP server's dependencies and Ollama (nomic-embed-text) running; builds
+# the index first if mcp_server/faiss_index is missing.
+
+# Run from the agent root: python benchmarks/document_search.py [--k 5] [--repeat 20]
+
+# benchmarks/document_search.py
+
+import argparse
+import sys
+import time
+from pathlib import Path
+import numpy as np
+
+ROOT = Path(__file__).parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / "mcp_server"))
+import mcp_server_2 as server
+
+# (query, documents that answer it)
+QUERIES = [
+    ("NSE/INVG/67564", ["INVG67564.pdf"]),
+    ("Circular Ref. No 463/2025", ["INVG67564.pdf"]),
+    ("Anmol Singh Jaggi", ["INVG67564.pdf", "economic.md"]),
+    ("SEBI interim order against Gensol Engineering", ["INVG67564.pdf", "economic.md"]),
+    ("DLF Gateway Tower Gurugram", ["DLF_13072023190044_BRSR.pdf"]),
+    ("Business Responsibility and Sustainability Report", ["DLF_13072023190044_BRSR.pdf"]),
+    ("Who founded DLF?", ["dlf.md"]),
+    ("Competition Commission of India penalty on DLF", ["dlf.md"]),
+    ("How many players are in a cricket team?", ["cricket.txt"]),
+    ("22-yard pitch with a wicket at each end", ["cricket.txt"]),
+    ("Matthew Rimmer", ["Tesla_Motors_IP_Open_Innovation_and_the_Carbon_Crisis_-_Matthew_Rimmer.pdf"]),
+    ("Why did Tesla open its patents?", ["Tesla_Motors_IP_Open_Innovation_and_the_Carbon_Crisis_-_Matthew_Rimmer.pdf"]),
+    ("canvas.theschoolofai.com EVA class", ["How to use Canvas LMS.pdf"]),
+    ("convert_stream binary file-like object", ["markitdown.md"]),
+    ("Convert PowerPoint and Excel files to Markdown", ["markitdown.md"]),
+    ("Experience letter template", ["Experience Letter.docx"]),
+    ("Indian policies and procedures for the school district", ["SAMPLE-Indian-Policies-and-Procedures-January-2023.docx"]),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Latency and recall of document search modes")
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--repeat", type=int, default=20, help="timed runs per query and mode")
+    args = parser.parse_args()
+
+    server.documents.get()  # load (or build) the index before timing
+    indexed = set(server.chunk_store.documents())
+    queries = [(q, expected) for q, expected in QUERIES if indexed & set(expected)]
+    if not queries:
+        sys.exit("None of the benchmark documents are indexed")
+
+    start = time.perf_counter()
+    vectors = server.get_embeddings([q for q, _ in queries])
+    print(f"{len(queries)} queries, {server.chunk_store.count()} chunks; "
+          f"embedding all queries took {(time.perf_counter() - start) * 1000:.0f} ms (excluded below)")
+
+    print(f"{'mode':<10}{'recall@' + str(args.k):>10}{'MRR':>8}{'p50 ms':>10}{'p95 ms':>10}")
+    for mode in server.SEARCH_MODES:
+        latencies, hits, reciprocal_ranks = [], 0, []
+        for (query, expected), vector in zip(queries, vectors):
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                results = server.retrieve_chunks(query, mode, args.k, query_vec=vector)
+                latencies.append(time.perf_counter() - start)
+            rank = next((i + 1 for i, row in enumerate(results) if row["doc"] in expected), None)
+            hits += rank is not None
+            reciprocal_ranks.append(1 / rank if rank else 0.0)
+        p50, p95 = np.percentile(latencies, [50, 95]) * 1000
+        print(f"{mode:<10}{hits / len(queries):>10.2f}{np.mean(reciprocal_ranks):>8.2f}{p50:>10.2f}{p95:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
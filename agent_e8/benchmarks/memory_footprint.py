@@ -0,0 +1,89 @@
+# benchmarks/memory_footprint.py → Memory Footprint Benchmark
+# Role: Measures per-item memory of MemoryManager's stored metadata and vectors.
+
+# Compares the previous layout (a pydantic MemoryItem per entry plus a Python list of
+# per-item np.ndarray embeddings next to the FAISS index) with the current one
+# (slotted MemoryRecord with interned strings; vectors only in the FAISS index).
+
+# Run from the agent root: python benchmarks/memory_footprint.py [--items 20000] [--dim 768]
+
+# benchmarks/memory_footprint.py
+
+import argparse
+import gc
+import sys
+import tracemalloc
+from pathlib import Path
+import numpy as np
+import faiss
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from modules.memory import MemoryItem, MemoryRecord
+
+
+def synthetic_items(count: int):
+    """Tool outputs shaped like the agent loop's: repeated tools, sessions and queries."""
+    rng = np.random.default_rng(0)
+    tools = ["search_documents", "extract_webpage", "add", "strings_to_chars_to_int", "int_list_to_exponential_sum"]
+    for i in range(count):
+        tool = tools[i % len(tools)]
+        session = f"session-{i // 20}"
+        query = f"Original user task: question {i // 20} about topic {i % 7}"
+        text = f"{tool}({{'query': 'q{i}'}}) → " + " ".join(f"word{w}" for w in rng.integers(0, 5000, 60))
+        yield {
+            "id": i, "text": text, "type": "tool_output", "timestamp": f"2025-05-01T10:{i % 60:02d}:00.000000",
+            "tool_name": tool, "user_query": query, "tags": [tool], "session_id": session
+        }
+
+
+def measure(build) -> int:
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    kept = build()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    del kept
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-item memory of agent memory storage")
+    parser.add_argument("--items", type=int, default=20000)
+    parser.add_argument("--dim", type=int, default=768)  # nomic-embed-text
+    args = parser.parse_args()
+
+    # Fresh string copies per layout, as if each had just been parsed from items.jsonl
+    rows = list(synthetic_items(args.items))
+    vectors = np.random.default_rng(1).random((args.items, args.dim), dtype=np.float32)
+    text_bytes = sum(sys.getsizeof(row["text"]) for row in rows)
+
+    def legacy():
+        items = [MemoryItem(**{k: (v.encode().decode() if isinstance(v, str) else v) for k, v in row.items()}) for row in rows]
+        embeddings = [np.array(vector) for vector in vectors]
+        return items, embeddings
+
+    def compact():
+        return [MemoryRecord.from_dict({k: (v.encode().decode() if isinstance(v, str) else v) for k, v in row.items()}) for row in rows]
+
+    legacy_bytes = measure(legacy)
+    compact_bytes = measure(compact)
+    index_bytes = args.items * args.dim * 4  # FAISS flat storage, allocated in C++ (not seen by tracemalloc)
+
+    print(f"{args.items} items, dim {args.dim}; item text alone is {text_bytes / args.items:.0f} B/item")
+    print(f"{'layout':<44}{'Python heap':>14}{'+ FAISS':>12}{'overhead/item':>16}")
+    for name, heap in [
+        ("MemoryItem + ndarray list (before)", legacy_bytes),
+        ("MemoryRecord, vectors only in FAISS (now)", compact_bytes),
+    ]:
+        overhead = (heap - text_bytes) / args.items
+        print(f"{name:<44}{heap / 2**20:>11.1f} MB{(heap + index_bytes) / 2**20:>9.1f} MB{overhead:>13.0f} B")
+
+    index = faiss.IndexFlatL2(args.dim)
+    index.add(vectors)
+    print(f"FAISS flat index: {index.ntotal} vectors, {index_bytes / 2**20:.1f} MB contiguous float32")
+
+
+if __name__ == "__main__":
+    main()
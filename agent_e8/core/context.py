@@ -22,7 +22,7 @@
 # core/context.py
 
 from typing import List, Optional, Dict, Any
-from modules.memory import MemoryManager, MemoryItem
+from modules.memory import MemoryItem, get_shared_memory
 from pathlib import Path
 import yaml
 import time
@@ -58,10 +58,8 @@ class AgentContext:
         self.agent_profile = profile or AgentProfile()
         self.session_id = f"session-{int(time.time())}-{uuid.uuid4().hex[:6]}"
         self.step = 0
-        self.memory = MemoryManager(
-            embedding_model_url=self.agent_profile.memory_config["embedding_url"],
-            model_name=self.agent_profile.memory_config["embedding_model"]
-        )
+        # Loaded once per process and shared; sessions stay apart via session_id
+        self.memory = get_shared_memory(self.agent_profile.memory_config)
         self.memory_trace: List[MemoryItem] = []
         self.tool_calls: List[ToolCallTrace] = []
         self.final_answer: Optional[str] = None
@@ -1,12 +1,15 @@
 # core/loop.py
 
 import asyncio
+from typing import Optional
 from core.context import AgentContext
 from core.session import MultiMCP
 from core.strategy import decide_next_action
+from modules.decision import continue_plan, end_chat
 from modules.perception import extract_perception, PerceptionResult
-from modules.action import ToolCallResult, parse_function_call
-from modules.memory import MemoryItem
+from modules.action import ToolCallResult, PlannedAction, parse_function_call
+from modules.memory import MemoryItem, call_key
+from modules.model_manager import ModelManager
 import json
 from config.log_config import setup_logging
 
@@ -18,6 +21,10 @@ class AgentLoop:
         self.context = AgentContext(user_input)
         self.mcp = dispatcher
         self.tools = dispatcher.get_all_tools()
+        conversation = self.context.agent_profile.llm_config.get("conversation", {})
+        self.chat_mode = conversation.get("mode", "stateless") == "chat"
+        self.memory_scope = self.context.agent_profile.memory_config.get("retrieve_scope", "session")
+        self.tool_dedupe = self.context.agent_profile.memory_config.get("tool_dedupe", {})
 
     def tool_expects_input(self, tool_name: str) -> bool:
         tool = next((t for t in self.tools if getattr(t, "name", None) == tool_name), None)
@@ -26,7 +33,23 @@ class AgentLoop:
         parameters = getattr(tool, "parameters", {})
         return list(parameters.keys()) == ["input"]
 
-    
+    def find_earlier_result(self, tool_name: str, tool_input) -> Optional[str]:
+        """A fresh stored result of the same read-only call (or a reworded one), if any."""
+        dedupe = self.tool_dedupe
+        if not dedupe.get("enabled") or tool_name not in dedupe.get("read_only_tools", []):
+            return None
+        found = self.context.memory.find_tool_result(
+            tool_name,
+            tool_input,
+            max_age_seconds=dedupe.get("ttl_seconds"),
+            semantic_threshold=dedupe.get("semantic_threshold") if tool_name in dedupe.get("semantic_tools", []) else None
+        )
+        if found is None:
+            return None
+        result_str, match, matched_call = found
+        print(f"[dedupe] Reusing {match} match for {tool_name}({tool_input}) from earlier call {matched_call}; tool not called")
+        return result_str
+
 
     async def run(self) -> str:
         print(f"[agent] Starting session: {self.context.session_id}")
@@ -34,78 +57,97 @@ class AgentLoop:
         try:
             max_steps = self.context.agent_profile.max_steps
             query = self.context.user_input
+            last_result = None
 
             for step in range(max_steps):
                 self.context.step = step
                 print(f"[loop] Step {step + 1} of {max_steps}")
 
-                # 🧠 Perception
-                perception_raw = await extract_perception(query)
+                # 💬 Conversation mode: later steps only append the new tool result
+                if self.chat_mode and last_result is not None:
+                    plan = await continue_plan(
+                        session_id=self.context.session_id,
+                        last_result=last_result,
+                        step_num=step + 1,
+                        max_steps=max_steps
+                    )
+                    await asyncio.sleep(0.2)
+                    print(f"[plan] {plan}")
+                else:
+                    # 🧠 Perception
+                    perception_raw = await extract_perception(query)
 
-                await asyncio.sleep(0.2)
+                    await asyncio.sleep(0.2)
 
 
-                # ✅ Exit cleanly on FINAL_ANSWER
-                # ✅ Handle string outputs safely before trying to parse
-                if isinstance(perception_raw, str):
-                    pr_str = perception_raw.strip()
+                    # ✅ Exit cleanly on FINAL_ANSWER
+                    # ✅ Handle string outputs safely before trying to parse
+                    if isinstance(perception_raw, str):
+                        pr_str = perception_raw.strip()
                     
-                    # Clean exit if it's a FINAL_ANSWER
-                    if pr_str.startswith("FINAL_ANSWER:"):
-                        self.context.final_answer = pr_str
-                        break
-
-                    # Detect LLM echoing the prompt
-                    if "Your last tool produced this result" in pr_str or "Original user task:" in pr_str:
-                        print("[perception] ⚠️ LLM likely echoed prompt. No actionable plan.")
-                        self.context.final_answer = "FINAL_ANSWER: [no result]"
-                        break
-
-                    # Try to decode stringified JSON if it looks valid
-                    try:
-                        perception_raw = json.loads(pr_str)
-                    except json.JSONDecodeError:
-                        print("[perception] ⚠️ LLM response was neither valid JSON nor actionable text.")
-                        self.context.final_answer = "FINAL_ANSWER: [no result]"
-                        break
-
+                        # Clean exit if it's a FINAL_ANSWER
+                        if pr_str.startswith("FINAL_ANSWER:"):
+                            self.context.final_answer = pr_str
+                            break
+
+                        # Detect LLM echoing the prompt
+                        if "Your last tool produced this result" in pr_str or "Original user task:" in pr_str:
+                            print("[perception] ⚠️ LLM likely echoed prompt. No actionable plan.")
+                            self.context.final_answer = "FINAL_ANSWER: [no result]"
+                            break
+
+                        # Try to decode stringified JSON if it looks valid
+                        try:
+                            perception_raw = json.loads(pr_str)
+                        except json.JSONDecodeError:
+                            print("[perception] ⚠️ LLM response was neither valid JSON nor actionable text.")
+                            self.context.final_answer = "FINAL_ANSWER: [no result]"
+                            break
+
+
+                    # ✅ Try parsing PerceptionResult
+                    if isinstance(perception_raw, PerceptionResult):
+                        perception = perception_raw
+                    else:
+                        try:
+                            # Attempt to parse stringified JSON if needed
+                            if isinstance(perception_raw, str):
+                                perception_raw = json.loads(perception_raw)
+                            perception = PerceptionResult(**perception_raw)
+                        except Exception as e:
+                            print(f"[perception] ⚠️ LLM perception failed: {e}")
+                            print(f"[perception] Raw output: {perception_raw}")
+                            break
+
+                    print(f"[perception] Intent: {perception.intent}, Hint: {perception.tool_hint}")
+
+                    # 💾 Memory Retrieval
+                    retrieved = self.context.memory.retrieve(
+                        query=query,
+                        top_k=self.context.agent_profile.memory_config["top_k"],
+                        type_filter=self.context.agent_profile.memory_config.get("type_filter", None),
+                        session_filter=self.context.session_id if self.memory_scope == "session" else None
+                    )
+                    print(f"[memory] Retrieved {len(retrieved)} memories (scores: {[m.score for m in retrieved]})")
+
+                    # 📊 Planning (via strategy)
+                    plan = await decide_next_action(
+                        context=self.context,
+                        perception=perception,
+                        memory_items=retrieved,
+                        all_tools=self.tools,
+                        session_id=self.context.session_id if self.chat_mode else None
+                    )
+                    await asyncio.sleep(0.2)
+                    print(f"[plan] {plan}")
 
-                # ✅ Try parsing PerceptionResult
-                if isinstance(perception_raw, PerceptionResult):
-                    perception = perception_raw
-                else:
-                    try:
-                        # Attempt to parse stringified JSON if needed
-                        if isinstance(perception_raw, str):
-                            perception_raw = json.loads(perception_raw)
-                        perception = PerceptionResult(**perception_raw)
-                    except Exception as e:
-                        print(f"[perception] ⚠️ LLM perception failed: {e}")
-                        print(f"[perception] Raw output: {perception_raw}")
+                # 🧾 Structured plans arrive as validated objects; text plans are parsed below
+                if isinstance(plan, PlannedAction):
+                    if plan.action == "final_answer":
+                        self.context.final_answer = str(plan)
                         break
 
-                print(f"[perception] Intent: {perception.intent}, Hint: {perception.tool_hint}")
-
-                # 💾 Memory Retrieval
-                retrieved = self.context.memory.retrieve(
-                    query=query,
-                    top_k=self.context.agent_profile.memory_config["top_k"],
-                    type_filter=self.context.agent_profile.memory_config.get("type_filter", None),
-                    session_filter=self.context.session_id
-                )
-                print(f"[memory] Retrieved {len(retrieved)} memories")
-
-                # 📊 Planning (via strategy)
-                plan = await decide_next_action(
-                    context=self.context,
-                    perception=perception,
-                    memory_items=retrieved,
-                    all_tools=self.tools
-                )
-                await asyncio.sleep(0.2)
-                print(f"[plan] {plan}")
-
-                if "FINAL_ANSWER:" in plan:
+                elif "FINAL_ANSWER:" in plan:
                     # Optionally extract the final answer portion
                     final_lines = [line for line in plan.splitlines() if line.strip().startswith("FINAL_ANSWER:")]
                     if final_lines:
@@ -117,35 +159,45 @@ class AgentLoop:
 
                 # ⚙️ Tool Execution
                 try:
-                    tool_name, arguments = parse_function_call(plan)
+                    if isinstance(plan, PlannedAction):
+                        tool_name, arguments = plan.tool_name, plan.to_arguments()
+                    else:
+                        tool_name, arguments = parse_function_call(plan)
 
                     if self.tool_expects_input(tool_name):
                         tool_input = {'input': arguments} if not (isinstance(arguments, dict) and 'input' in arguments) else arguments
                     else:
                         tool_input = arguments
 
-                    response = await self.mcp.call_tool(tool_name, tool_input)
-
-                    # ✅ Safe TextContent parsing
-                    raw = getattr(response.content, 'text', str(response.content))
-                    try:
-                        result_obj = json.loads(raw) if raw.strip().startswith("{") else raw
-                    except json.JSONDecodeError:
-                        result_obj = raw
-
-                    result_str = result_obj.get("markdown") if isinstance(result_obj, dict) else str(result_obj)
-                    print(f"[action] {tool_name} → {result_str}")
-
-                    # 🧠 Add memory
-                    memory_item = MemoryItem(
-                        text=f"{tool_name}({arguments}) → {result_str}",
-                        type="tool_output",
-                        tool_name=tool_name,
-                        user_query=query,
-                        tags=[tool_name],
-                        session_id=self.context.session_id
-                    )
-                    self.context.add_memory(memory_item)
+                    # ♻️ Read-only calls already answered recently skip the dispatch (and its process spawn)
+                    result_str = self.find_earlier_result(tool_name, tool_input)
+                    if result_str is not None:
+                        print(f"[action] {tool_name} → {result_str}")
+                    else:
+                        response = await self.mcp.call_tool(tool_name, tool_input)
+
+                        # ✅ Safe TextContent parsing
+                        raw = getattr(response.content, 'text', str(response.content))
+                        try:
+                            result_obj = json.loads(raw) if raw.strip().startswith("{") else raw
+                        except json.JSONDecodeError:
+                            result_obj = raw
+
+                        result_str = result_obj.get("markdown") if isinstance(result_obj, dict) else str(result_obj)
+                        print(f"[action] {tool_name} → {result_str}")
+
+                        # 🧠 Add memory
+                        memory_item = MemoryItem(
+                            text=f"{tool_name}({arguments}) → {result_str}",
+                            type="tool_output",
+                            tool_name=tool_name,
+                            user_query=query,
+                            tags=[tool_name],
+                            session_id=self.context.session_id,
+                            call_key=call_key(tool_name, tool_input)
+                        )
+                        self.context.add_memory(memory_item)
+                    last_result = result_str
 
                     # 🔁 Next query
                     query = f"""Original user task: {self.context.user_input}
@@ -165,6 +217,15 @@ class AgentLoop:
         except Exception as e:
             print(f"[agent] Session failed: {e}")
 
+        finally:
+            self.context.memory.flush()
+            if self.chat_mode:
+                end_chat(self.context.session_id)
+            print(f"[tokens] Usage so far by stage: {ModelManager.usage_report()}")
+            index_stats = self.context.memory.index_stats()
+            print(f"[memory] Index: {index_stats['type']}, {index_stats['ntotal']} vectors, "
+                  f"p95 {index_stats.get('latency_ms_p95')}ms, recall@10 {index_stats.get('recall_at_10')}")
+
         return self.context.final_answer or "FINAL_ANSWER: [no result]"
 
 
@@ -86,8 +86,10 @@ def to_tool_obj(tool):
 
 class MultiMCP:
     """
-    Stateless version: discovers tools from multiple MCP servers, but reconnects per tool call.
-    Each call_tool() uses a fresh session based on tool-to-server mapping.
+    Discovers tools from multiple MCP servers, and by default reconnects per tool call:
+    each call_tool() uses a fresh session based on tool-to-server mapping.
+    Stdio servers marked `persistent: true` are started once and keep one session
+    (and whatever the server holds in memory) until shutdown().
     """
 
     def __init__(self, server_configs: List[dict]):
@@ -95,6 +97,55 @@ class MultiMCP:
         self.tool_map: Dict[str, Dict[str, Any]] = {}  # tool_name → {config, tool}
         self._processes = []
         self._transports = []
+        self._sessions: Dict[str, asyncio.Future] = {}              # server id → session (once initialized)
+        self._session_tasks: Dict[str, asyncio.Task] = {}
+        self._session_stops: Dict[str, asyncio.Event] = {}
+
+    @staticmethod
+    def _stdio_params(config: dict) -> StdioServerParameters:
+        return StdioServerParameters(
+            command="uv",
+            args=["run", config["script"]],
+            cwd=config.get("cwd", os.getcwd())
+        )
+
+    async def _hold_session(self, server_id: str, config: dict, ready: asyncio.Future, stop: asyncio.Event):
+        # One task owns the transport and session contexts, so they are entered and exited in the same task
+        try:
+            async with stdio_client(self._stdio_params(config)) as (read, write):
+                async with ClientSession(read, write) as session:
+                    await session.initialize()
+                    ready.set_result(session)
+                    print(f"→ Persistent session opened: {server_id}")
+                    await stop.wait()
+        except Exception as e:
+            if not ready.done():
+                ready.set_exception(e)
+            else:
+                print(f"❌ Persistent session to {server_id} closed: {e}")
+        finally:
+            self._sessions.pop(server_id, None)
+            self._session_tasks.pop(server_id, None)
+            self._session_stops.pop(server_id, None)
+
+    async def _persistent_session(self, config: dict) -> ClientSession:
+        """The long-lived session to a `persistent` stdio server, started on first use."""
+        server_id = config.get("id", config["script"])
+        if server_id not in self._sessions:
+            # Registered before the first await, so concurrent first calls share one server
+            ready = asyncio.get_running_loop().create_future()
+            stop = asyncio.Event()
+            self._sessions[server_id] = ready
+            self._session_stops[server_id] = stop
+            self._session_tasks[server_id] = asyncio.create_task(self._hold_session(server_id, config, ready, stop))
+        return await self._sessions[server_id]
+
+    async def _close_session(self, server_id: str):
+        stop, task = self._session_stops.get(server_id), self._session_tasks.get(server_id)
+        if stop is not None:
+            stop.set()
+        if task is not None:
+            await task
 
     async def _cleanup(self):
         for process in self._processes:
@@ -118,12 +169,23 @@ class MultiMCP:
         print("in MultiMCP initialize")
         for config in self.server_configs:
             try:
-                if config["type"] == "stdio":
-                    params = StdioServerParameters(
-                        command="uv",
-                        args=["run", config["script"]],
-                        cwd=config.get("cwd", os.getcwd())
-                    )
+                if config["type"] == "stdio" and config.get("persistent"):
+                    print(f"→ Starting persistent server: {config['script']}")
+                    try:
+                        session = await self._persistent_session(config)
+                        tools_result = await session.list_tools()
+                        tools = tools_result.tools
+                        print(f"→ Tools received: {[tool.name for tool in tools]}")
+                        for tool in tools:
+                            tool_obj = to_tool_obj(tool)
+                            self.tool_map[tool_obj.name] = {
+                                "config": config,
+                                "tool": tool_obj
+                            }
+                    except Exception as e:
+                        print(f"❌ STDIO Connection error: {e}")
+                elif config["type"] == "stdio":
+                    params = self._stdio_params(config)
                     print(f"→ Scanning tools from: {config['script']} in {params.cwd}")
                     try:
                         async with stdio_client(params) as (read, write):
@@ -169,13 +231,19 @@ class MultiMCP:
             raise ValueError(f"Tool '{tool_name}' not found on any server.")
 
         config = entry["config"]
+        if config["type"] == "stdio" and config.get("persistent"):
+            try:
+                session = await self._persistent_session(config)
+                return await session.call_tool(tool_name, arguments)
+            except Exception as e:
+                print(f"❌ Error calling tool {tool_name}: {e}")
+                # Drop the session; the next call starts the server again
+                await self._close_session(config.get("id", config["script"]))
+                raise
+
         try:
             if config["type"] == "stdio":
-                params = StdioServerParameters(
-                    command="uv",
-                    args=["run", config["script"]],
-                    cwd=config.get("cwd", os.getcwd())
-                )
+                params = self._stdio_params(config)
                 async with stdio_client(params) as (read, write):
                     async with ClientSession(read, write) as session:
                         await session.initialize()
@@ -198,4 +266,6 @@ class MultiMCP:
         return [entry["tool"] for entry in self.tool_map.values()]
 
     async def shutdown(self):
+        for server_id in list(self._session_tasks):
+            await self._close_session(server_id)
         await self._cleanup()
\ No newline at end of file
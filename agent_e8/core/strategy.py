@@ -28,7 +28,8 @@ from modules.memory import MemoryItem
 from modules.tools import summarize_tools, filter_tools_by_hint
 from modules.decision import generate_plan
 from core.context import AgentContext
-from typing import Any
+from modules.action import PlannedAction
+from typing import Any, Optional, Union
 
 
 async def decide_next_action(
@@ -37,10 +38,12 @@ async def decide_next_action(
     memory_items: list[MemoryItem],
     all_tools: list[Any],
     last_result: str = "",
-) -> str:
+    session_id: Optional[str] = None,
+) -> Union[str, PlannedAction]:
     """
     Decides what to do next using the planning strategy defined in agent profile.
     Wraps around the `generate_plan()` logic with strategy-aware control.
+    `session_id` opens a planning conversation (see `continue_plan()`).
     """
 
     strategy = context.agent_profile.strategy
@@ -58,21 +61,23 @@ async def decide_next_action(
         tool_descriptions=filtered_summary,
         step_num=step,
         max_steps=max_steps,
+        session_id=session_id,
     )
 
     # Strategy enforcement
     if strategy == "conservative":
         return plan
 
-    if strategy == "retry_once" and "unknown" in plan.lower():
+    if strategy == "retry_once" and "unknown" in str(plan).lower():
         # Retry with all tools if hint-based filtering failed
         full_summary = summarize_tools(all_tools)
-        return generate_plan(
+        return await generate_plan(
             perception=perception,
             memory_items=memory_items,
             tool_descriptions=full_summary,
             step_num=step,
             max_steps=max_steps,
+            session_id=session_id,
         )
 
     # Placeholder for future "explore_all" parallel planner
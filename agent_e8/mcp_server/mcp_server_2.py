@@ -7,14 +7,17 @@ import math
 import sys
 import os
 import json
-import faiss
 import numpy as np
 from pathlib import Path
 import requests
 from markitdown import MarkItDown
 import time
+import threading
+import asyncio
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
+from contextlib import contextmanager, nullcontext
 from models import AddInput, AddOutput, SqrtInput, SqrtOutput, StringsToIntsInput, StringsToIntsOutput, ExpSumInput, ExpSumOutput, PythonCodeInput, PythonCodeOutput, UrlInput, FilePathInput, MarkdownInput, MarkdownOutput, ChunkListOutput
-from tqdm import tqdm
 import hashlib
 from pydantic import BaseModel
 import subprocess
@@ -23,11 +26,19 @@ import trafilatura
 import pymupdf4llm
 import re
 import base64 # ollama needs base64-encoded-image
+import io
+
+sys.path.insert(0, str(Path(__file__).parent.parent.resolve()))  # agent root → shared modules/
+from modules.warmup import OllamaWarmup
+from modules.embedding_cache import EmbeddingCache
+from modules.vector_index import AdaptiveIndex
+from modules.chunk_store import ChunkStore
+from modules.caption_cache import CaptionCache, image_hash
 
 
 mcp = FastMCP("Calculator")
 
-EMBED_URL = "http://localhost:11434/api/embeddings"
+EMBED_URL = "http://localhost:11434/api/embed"  # returns normalized vectors, same as agent memory
 OLLAMA_CHAT_URL = "http://localhost:11434/api/chat"
 OLLAMA_URL = "http://localhost:11434/api/generate"
 EMBED_MODEL = "nomic-embed-text"
@@ -37,23 +48,151 @@ CHUNK_SIZE = 256
 CHUNK_OVERLAP = 40
 MAX_CHUNK_LENGTH = 512  # characters
 TOP_K = 3  # FAISS top-K matches
+# Ingestion pipeline: extraction runs in worker processes, model calls are bounded per backend
+EXTRACT_WORKERS = int(os.getenv("INGEST_EXTRACT_WORKERS", os.cpu_count() or 2))
+SEGMENT_CONCURRENCY = int(os.getenv("INGEST_SEGMENT_CONCURRENCY", 2))  # files in semantic_merge at once (phi4)
+# Segmentation per run: "embedding" (structure + sentence similarity) or "llm" (semantic_merge, opt-in)
+SEGMENT_MODE = os.getenv("INGEST_SEGMENT_MODE", "embedding")
+SEGMENT_SIMILARITY = float(os.getenv("INGEST_SEGMENT_SIMILARITY", 0.65))  # next sentence below this starts a new chunk
+SEGMENT_MIN_WORDS = 40    # chunks smaller than this keep absorbing sentences regardless of similarity
+SEGMENT_MAX_WORDS = 512   # same bound as semantic_merge's windows
+CAPTION_CONCURRENCY = int(os.getenv("INGEST_CAPTION_CONCURRENCY", 2))  # images captioned at once (gemma3), across all files
+MIN_IMAGE_BYTES = 2048  # smaller images (icons, bullets, spacers) are dropped instead of captioned
+MIN_IMAGE_SIDE = 48     # ...as are images narrower or shorter than this many pixels
+CAPTION_IMAGE_SIDE = 896  # gemma3's vision input resolution; larger images are downscaled before upload
+EMBED_CONCURRENCY = int(os.getenv("INGEST_EMBED_CONCURRENCY", 2))      # batched embedding requests in flight
+EMBED_BATCH_SIZE = 32  # texts per /api/embed request
+# Captioned markdown per file content hash; bump the version whenever extraction or captioning output changes
+EXTRACTOR_VERSION = "1"
+EXTRACTION_ATTEMPTS = 3  # runs that retry transiently failed images before the extraction is cached with placeholders
+MIN_SCORE = 0.4  # cosine similarity below which search_documents drops a chunk
+# Hybrid search: BM25 (chunk store FTS5) and vector rankings fused by reciprocal rank
+SEARCH_MODES = ("hybrid", "vector", "keyword")
+SEARCH_CANDIDATES = 20  # results taken from each ranking before fusion
+RRF_K = 60              # reciprocal rank fusion constant; damps the weight of top ranks
+BM25_MIN_SCORE = 2.0    # keyword hits scoring lower don't enter hybrid fusion (one common term in a long chunk)
+# Document index starts flat and is rebuilt as HNSW / IVF once the corpus grows past these sizes
+INDEX_CONFIG = {
+    "metric": "cosine",    # an existing L2 index.bin is migrated on first load
+    "hnsw_threshold": 20000,
+    "ivf_threshold": 200000,
+    "quantize": False,     # SQ8 vectors in the rebuilt index
+    "tombstone_ratio": 0.2,  # compact (rebuild without them) once this share of vectors belongs to replaced chunks
+    "background": False,   # indexing is a batch job, so rebuild inline before saving
+    "log": lambda msg: mcp_log("INDEX", msg),
+}
 ROOT = Path(__file__).parent.resolve()
+EXTRACTION_CACHE = ROOT.parent / "cache" / "extractions"  # shared agent cache dir (git-ignored)
+
+# keep_alive comes from profiles.yaml (warmup section), same as the agent's own requests.
+# Only the embedding model (needed by every search) is preloaded; phi4 and gemma3 serve
+# ingestion alone (--segment llm, new images), so they are warmed the first time it needs them
+warmup = OllamaWarmup.from_profile()
+warmup.models = [{"name": EMBED_MODEL, "kind": "embed"}] if warmup.models else []  # empty = warmup disabled
+warmup.log = lambda msg: mcp_log("INFO", msg)
+KEEP_ALIVE = warmup.keep_alive  # keep Ollama models resident between tool calls
+warmup_lock = threading.Lock()
+
+
+def warm_model(name: str):
+    """Preloads a generation model before this process first uses it (no-op once loaded)."""
+    with warmup_lock:
+        if warmup.load_state.get(name) != "loaded":
+            warmup.warmup([{"name": name, "kind": "generate"}])
+
+# Shared with agent memory (cache/embeddings); the space names the endpoint the vectors came from
+embedding_cache = EmbeddingCache(f"{EMBED_MODEL}:embed")
+# Captions by image content hash (cache/captions.sqlite); one pool bounds gemma3 requests for every file
+caption_cache = CaptionCache()
+caption_pool = ThreadPoolExecutor(max_workers=CAPTION_CONCURRENCY, thread_name_prefix="caption")
+
+
+def get_embeddings(texts: list[str]) -> np.ndarray:
+    """Embeddings for many texts: cached ones from the cache, the rest in batched requests."""
+    return embedding_cache.embed(texts, request_embeddings)
+
+def request_embeddings(texts: list[str]) -> np.ndarray:
+    vectors = []
+    for start in range(0, len(texts), EMBED_BATCH_SIZE):
+        response = requests.post(EMBED_URL, json={
+            "model": EMBED_MODEL, "input": texts[start:start + EMBED_BATCH_SIZE], "keep_alive": KEEP_ALIVE
+        })
+        response.raise_for_status()
+        data = response.json()
+        warmup.record(EMBED_MODEL, data)
+        vectors.extend(data["embeddings"])
+    return np.array(vectors, dtype=np.float32)
+
+def mcp_log(level: str, message: str) -> None:
+    sys.stderr.write(f"{level}: {message}\n")
+    sys.stderr.flush()
 
 
-def get_embedding(text: str) -> np.ndarray:
-    response = requests.post(EMBED_URL, json={"model": EMBED_MODEL, "prompt": text})
-    response.raise_for_status()
-    return np.array(response.json()["embedding"], dtype=np.float32)
+class ResidentIndex:
+    """
+    Document index, loaded once and kept for the life of the server. Each call stats
+    the files; they are re-read (and swapped in) only when their mtime/size stamp
+    changes, so a steady-state search is one embedding, one FAISS search and a lookup
+    of the returned ids in the chunk store.
+    """
+
+    def __init__(self, index_path: Path):
+        self.index_path = index_path
+        self.index: AdaptiveIndex | None = None
+        self.stamp = None
+        self.reloads = 0
+        self._lock = threading.Lock()
+
+    def _stamp(self) -> tuple:
+        stamp = []
+        for path in [self.index_path, self.index_path.with_name(self.index_path.name + ".json")]:
+            try:
+                stat = path.stat()
+                stamp.append((stat.st_mtime_ns, stat.st_size))
+            except FileNotFoundError:
+                stamp.append(None)
+        return tuple(stamp)
+
+    def get(self) -> AdaptiveIndex:
+        if self.index is None:
+            ensure_faiss_ready()
+        stamp = self._stamp()
+        if stamp != self.stamp:
+            with self._lock:
+                if stamp != self.stamp:
+                    self._reload(stamp)
+        return self.index
+
+    def _reload(self, stamp: tuple):
+        try:
+            index = AdaptiveIndex.load(self.index_path, **INDEX_CONFIG)
+            if index.migrated:
+                index.save(self.index_path)
+                stamp = self._stamp()
+        except Exception as e:
+            if self.index is None:
+                raise
+            mcp_log("WARN", f"Keeping the loaded document index; reload failed: {e}")
+            return
+        # One assignment: a search sees the old index or the new one
+        self.index = index
+        self.stamp = stamp
+        self.reloads += 1
+        mcp_log("INFO", f"Loaded document index ({index.kind}, {index.ntotal} vectors)")
+
+
+# Chunk rows are committed before their vectors are saved, so every id the index returns has a row
+chunk_store = ChunkStore(ROOT / "faiss_index" / "metadata.sqlite")
+if (migrated_rows := chunk_store.import_json(ROOT / "faiss_index" / "metadata.json")):
+    mcp_log("INFO", f"Moved {migrated_rows} chunks from metadata.json into metadata.sqlite")
+documents = ResidentIndex(ROOT / "faiss_index" / "index.bin")
+
 
 def chunk_text(text, size=CHUNK_SIZE, overlap=CHUNK_OVERLAP):
     words = text.split()
     for i in range(0, len(words), size - overlap):
         yield " ".join(words[i:i+size])
 
-def mcp_log(level: str, message: str) -> None:
-    sys.stderr.write(f"{level}: {message}\n")
-    sys.stderr.flush()
-
 # === CHUNKING ===
 
 
@@ -86,112 +225,280 @@ Just respond in one word (Yes or No), and do not provide any further explanation
     response = requests.post(OLLAMA_CHAT_URL, json={
         "model": PHI_MODEL,
         "messages": [{"role": "user", "content": prompt}],
-        "stream": False
+        "stream": False,
+        "keep_alive": KEEP_ALIVE
     })
     response.raise_for_status()
-    reply = response.json().get("message", {}).get("content", "").strip().lower()
+    data = response.json()
+    warmup.record(PHI_MODEL, data)
+    reply = data.get("message", {}).get("content", "").strip().lower()
     print(f"  ✅ Model reply: {reply}")
     return reply.startswith("yes")
 
 
 
+def retrieve_chunks(query: str, mode: str = "hybrid", k: int = 5, query_vec: np.ndarray | None = None) -> list[dict]:
+    """
+    Up to k chunk rows for the query, best first, with their "score" (cosine) and/or
+    "bm25", plus the fused "rrf" score in hybrid mode. Vector matches under MIN_SCORE
+    are dropped before fusion: weak matches would only cost the agent prompt tokens.
+    """
+    return retrieve_chunks_batch([query], mode, k, None if query_vec is None else query_vec.reshape(1, -1))[0]
+
+
+def retrieve_chunks_batch(
+    queries: list[str], mode: str = "hybrid", k: int = 5, query_vecs: np.ndarray | None = None
+) -> list[list[dict]]:
+    """
+    retrieve_chunks for many queries: one batched embedding request, one index.search
+    over the query matrix and one chunk store lookup for all of them.
+    """
+    if mode not in SEARCH_MODES:
+        raise ValueError(f"Unknown search mode: {mode} (expected one of {', '.join(SEARCH_MODES)})")
+    index = documents.get()
+    depth = k if mode != "hybrid" else SEARCH_CANDIDATES
+    scores = [{} for _ in queries]     # per query: vector id → {"score": cosine, "bm25": ...}
+    rankings = [[] for _ in queries]
+
+    if mode != "keyword":
+        query_vecs = get_embeddings(queries) if query_vecs is None else query_vecs
+        D, I = index.search(query_vecs, k=depth)
+        for q, (row_scores, row_ids) in enumerate(zip(D, I)):
+            hits = [(int(idx), float(score)) for score, idx in zip(row_scores, row_ids) if idx >= 0 and score >= MIN_SCORE]
+            rankings[q].append([idx for idx, _ in hits])
+            for idx, score in hits:
+                scores[q].setdefault(idx, {})["score"] = score
+
+    if mode != "vector":
+        for q, query in enumerate(queries):
+            # In hybrid mode weak keyword hits would fill the k slots the vector cut-off left empty
+            hits = chunk_store.search_text(query, depth, BM25_MIN_SCORE if mode == "hybrid" else 0.0)
+            rankings[q].append([idx for idx, _ in hits])
+            for idx, score in hits:
+                scores[q].setdefault(idx, {})["bm25"] = score
+
+    orders = []
+    for q in range(len(queries)):
+        if mode == "hybrid":
+            fused = {}
+            for ranking in rankings[q]:
+                for rank, idx in enumerate(ranking):
+                    fused[idx] = fused.get(idx, 0.0) + 1.0 / (RRF_K + rank + 1)
+            order = sorted(fused, key=fused.get, reverse=True)[:k]
+            for idx in order:
+                scores[q][idx]["rrf"] = fused[idx]
+        else:
+            order = rankings[q][0]
+        orders.append(order)
+
+    rows = chunk_store.get({idx for order in orders for idx in order})
+    return [[{**rows[idx], **scores[q][idx]} for idx in order if idx in rows] for q, order in enumerate(orders)]
+
+
+def format_scores(data: dict) -> str:
+    return ", ".join(f"{label}: {data[key]:.3f}" for key, label in [("score", "Score"), ("bm25", "BM25")] if key in data)
+
+
 @mcp.tool()
-def search_documents(query: str) -> list[str]:
-    """Search indexed documents for relevant content. Usage: search_documents|query="india Current GDP" """
-    ensure_faiss_ready()
-    mcp_log("SEARCH", f"Query: {query}")
+def search_documents(query: str, mode: str = "hybrid") -> list[str]:
+    """Search indexed documents for relevant content. mode: hybrid (default; keywords + meaning), vector (meaning only) or keyword (exact terms, e.g. IDs and names). Usage: search_documents|query="india Current GDP" """
+    mcp_log("SEARCH", f"Query ({mode}): {query}")
     try:
-        index = faiss.read_index(str(ROOT / "faiss_index" / "index.bin"))
-        metadata = json.loads((ROOT / "faiss_index" / "metadata.json").read_text())
-        query_vec = get_embedding(query).reshape(1, -1)
-        D, I = index.search(query_vec, k=5)
         results = []
-        for idx in I[0]:
-            data = metadata[idx]
-            results.append(f"{data['chunk']}\n[Source: {data['doc']}, ID: {data['chunk_id']}]")
-        return results
+        for data in retrieve_chunks(query, mode):
+            results.append(f"{data['chunk']}\n[Source: {data['doc']}, ID: {data['chunk_id']}, {format_scores(data)}]")
+        if mode == "vector":
+            return results or [f"No indexed content matched the query closely enough (cosine similarity < {MIN_SCORE})."]
+        return results or [f"No indexed content shares a term with the query or matched it closely enough (cosine similarity < {MIN_SCORE})."]
     except Exception as e:
         return [f"ERROR: Failed to search: {str(e)}"]
 
 
-def caption_image(img_url_or_path: str) -> str:
-    mcp_log("CAPTION", f"🖼️ Attempting to caption image: {img_url_or_path}")
+@mcp.tool()
+def search_documents_batch(queries: list[str], mode: str = "hybrid") -> list[str]:
+    """Search indexed documents for several queries in one call (one result block per query; a chunk already shown for an earlier query is referenced by ID, not repeated). mode as in search_documents. Usage: search_documents_batch|queries=["DLF revenue", "Gensol promoters"]"""
+    mcp_log("SEARCH", f"Batch of {len(queries)} queries ({mode}): {queries}")
+    try:
+        shown = {}  # vector id → number of the query whose block holds its text
+        blocks = []
+        for q, (query, results) in enumerate(zip(queries, retrieve_chunks_batch(queries, mode)), start=1):
+            lines = [f"### Query {q}: {query}"]
+            for data in results:
+                source = f"Source: {data['doc']}, ID: {data['chunk_id']}, {format_scores(data)}"
+                if data["vector_id"] in shown:
+                    lines.append(f"[Same chunk as in query {shown[data['vector_id']]} — {source}]")
+                else:
+                    shown[data["vector_id"]] = q
+                    lines.append(f"{data['chunk']}\n[{source}]")
+            if not results:
+                lines.append("No indexed content matched this query closely enough.")
+            blocks.append("\n\n".join(lines))
+        return blocks
+    except Exception as e:
+        return [f"ERROR: Failed to search: {str(e)}"]
 
-    full_path = Path(__file__).parent / "documents" / img_url_or_path
-    full_path = full_path.resolve()
 
-    if not full_path.exists():
-        mcp_log("ERROR", f"❌ Image file not found: {full_path}")
-        return f"[Image file not found: {img_url_or_path}]"
+@mcp.tool()
+def document_index_stats() -> str:
+    """Report the document index type with its search latency and recall figures. Usage: document_index_stats"""
+    stats = documents.get().stats()
+    stats["chunks"] = chunk_store.count()
+    stats["reloads"] = documents.reloads
+    return json.dumps(stats)
 
-    try:
-        if img_url_or_path.startswith("http"): # for extract_web_pages
-            response = requests.get(img_url_or_path)
-            encoded_image = base64.b64encode(response.content).decode("utf-8")
-        else:
-            with open(full_path, "rb") as img_file:
-                encoded_image = base64.b64encode(img_file.read()).decode("utf-8")
-
-        # Set stream=True to get the full generator-style output
-        with requests.post(OLLAMA_URL, json={
-            "model": GEMMA_MODEL,
-            "prompt": "If there is lot of text in the image, then ONLY reply back with exact text in the image, else Describe the image such that your response can replace 'alt-text' for it. Only explain the contents of the image and provide no further explaination.",
-            "images": [encoded_image],
-            "stream": True
-        }, stream=True) as response:
-
-            caption_parts = []
-            for line in response.iter_lines():
-                if not line:
-                    continue
-                try:
-                    data = json.loads(line)
-                    caption_parts.append(data.get("response", ""))
-                    if data.get("done", False):
-                        break
-                except json.JSONDecodeError:
-                    continue  # silently skip malformed lines
-
-            caption = "".join(caption_parts).strip()
-            mcp_log("CAPTION", f"✅ Caption generated: {caption}")
-            return caption if caption else "[No caption returned]"
 
-    except Exception as e:
-        mcp_log("ERROR", f"⚠️ Failed to caption image {img_url_or_path}: {e}")
-        return f"[Image could not be processed: {img_url_or_path}]"
+def image_label(src: str) -> str:
+    """How an image is named in logs and error text (never a whole data URI)."""
+    return f"embedded {src[5:src.find(';')] or 'image'} ({len(src) // 1024} KB)" if src.startswith("data:") else src
 
 
+def load_image(src: str) -> bytes:
+    if src.startswith("data:"):  # embedded by pdf_to_markdown
+        return base64.b64decode(src.split(",", 1)[1])
+    if src.startswith("http"):  # for extract_web_pages
+        response = requests.get(src, timeout=30)
+        response.raise_for_status()
+        return response.content
+    return (ROOT / "documents" / src).resolve().read_bytes()
 
 
+def is_transient(error: Exception) -> bool:
+    """Network trouble and server-side errors may clear up on a later run; missing, refused or broken images won't."""
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code >= 500 or error.response.status_code == 429
+    return isinstance(error, (requests.ConnectionError, requests.Timeout))
 
-def replace_images_with_captions(markdown: str) -> str:
-    def replace(match):
-        alt, src = match.group(1), match.group(2)
+
+def is_decorative(image: bytes) -> bool:
+    """Icons, bullets, rules and spacers: too small to be worth a caption."""
+    if len(image) < MIN_IMAGE_BYTES:
+        return True
+    try:
+        width, height = PILImage.open(io.BytesIO(image)).size
+    except Exception:
+        return False  # unreadable by PIL; let the captioner decide
+    return min(width, height) < MIN_IMAGE_SIDE
+
+
+def fit_for_captioning(image: bytes) -> bytes:
+    """Downscales (in memory) to the captioner's input resolution; smaller images pass through."""
+    try:
+        picture = PILImage.open(io.BytesIO(image))
+        if max(picture.size) <= CAPTION_IMAGE_SIDE:
+            return image
+        picture.thumbnail((CAPTION_IMAGE_SIDE, CAPTION_IMAGE_SIDE))
+        buffer = io.BytesIO()
+        picture.convert("RGB").save(buffer, format="JPEG", quality=90)
+        return buffer.getvalue()
+    except Exception:
+        return image  # unreadable by PIL; send as is
+
+
+def caption_image(image: bytes, label: str) -> str:
+    """Streams a gemma3 caption for the image; raises if none comes back."""
+    mcp_log("CAPTION", f"🖼️ Attempting to caption image: {label}")
+    encoded_image = base64.b64encode(fit_for_captioning(image)).decode("utf-8")
+
+    # Set stream=True to get the full generator-style output
+    with requests.post(OLLAMA_URL, json={
+        "model": GEMMA_MODEL,
+        "prompt": "If there is lot of text in the image, then ONLY reply back with exact text in the image, else Describe the image such that your response can replace 'alt-text' for it. Only explain the contents of the image and provide no further explaination.",
+        "images": [encoded_image],
+        "stream": True,
+        "keep_alive": KEEP_ALIVE
+    }, stream=True) as response:
+        response.raise_for_status()
+
+        caption_parts = []
+        for line in response.iter_lines():
+            if not line:
+                continue
+            try:
+                data = json.loads(line)
+                caption_parts.append(data.get("response", ""))
+                if data.get("done", False):
+                    warmup.record(GEMMA_MODEL, data)
+                    break
+            except json.JSONDecodeError:
+                continue  # silently skip malformed lines
+
+    caption = "".join(caption_parts).strip()
+    if not caption:
+        raise ValueError("no caption returned")
+    mcp_log("CAPTION", f"✅ Caption generated: {caption}")
+    return caption
+
+
+IMAGE_LINK = re.compile(r'!\[(.*?)\]\((.*?)\)')
+
+
+def replace_images_with_captions(markdown: str, stats: "StageStats | None" = None) -> tuple[str, bool]:
+    """
+    Replaces image links with captions. Each image is loaded once and deduplicated by
+    content hash; cached captions are reused, decorative images dropped, and the rest
+    captioned concurrently on the shared caption pool. Nothing is written to disk.
+    Returns (markdown, complete): complete is False if any image was left as an
+    "[Image could not be processed]" placeholder by a failure a later run might not hit
+    (network errors, 5xx, captioning errors); dead links and undecodable images are final.
+    """
+    sources = list(dict.fromkeys(match.group(2) for match in IMAGE_LINK.finditer(markdown)))
+    if not sources:
+        return markdown, True
+
+    replacements = {}
+    hash_of = {}   # src → image hash
+    images = {}    # image hash → (bytes, first src)
+    retryable = 0  # placeholders a later run might replace
+    for src in sources:
+        try:
+            image = load_image(src)
+        except Exception as e:
+            mcp_log("ERROR", f"❌ Image could not be loaded: {image_label(src)} ({e})")
+            replacements[src] = f"[Image could not be processed: {image_label(src)}]"
+            retryable += is_transient(e)
+            continue
+        if is_decorative(image):
+            replacements[src] = ""
+            continue
+        hash_of[src] = image_hash(image)
+        images.setdefault(hash_of[src], (image, src))
+
+    decorative = sum(replacement == "" for replacement in replacements.values())
+    captions = caption_cache.get_many(list(images), GEMMA_MODEL)
+    missing = [digest for digest in images if digest not in captions]
+
+    def caption(digest: str) -> str:
+        image, src = images[digest]
+        with stats.time("caption", "images") if stats else nullcontext():
+            return caption_image(image, image_label(src))
+
+    if missing:
+        warm_model(GEMMA_MODEL)
+    futures = {digest: caption_pool.submit(caption, digest) for digest in missing}
+    for digest, future in futures.items():
         try:
-            caption = caption_image(src)
-            # Attempt to delete only if local and file exists
-            if not src.startswith("http"):
-                img_path = Path(__file__).parent / "documents" / src
-                if img_path.exists():
-                    img_path.unlink()
-                    mcp_log("INFO", f"🗑️ Deleted image after captioning: {img_path}")
-            return f"**Image:** {caption}"
+            captions[digest] = future.result()
+            caption_cache.put(digest, GEMMA_MODEL, captions[digest])
         except Exception as e:
-            mcp_log("WARN", f"Image deletion failed: {e}")
-            return f"[Image could not be processed: {src}]"
+            mcp_log("ERROR", f"⚠️ Failed to caption image {image_label(images[digest][1])}: {e}")
 
-    return re.sub(r'!\[(.*?)\]\((.*?)\)', replace, markdown)
+    for src, digest in hash_of.items():
+        replacements[src] = f"**Image:** {captions[digest]}" if digest in captions else f"[Image could not be processed: {image_label(src)}]"
+    failed = sum(replacement.startswith("[Image could not be processed") for replacement in replacements.values())
+    retryable += sum(digest not in captions for digest in hash_of.values())  # captioning errors are worth another try
+    mcp_log("CAPTION", f"{len(sources)} images: {decorative} decorative, {len(images) - len(missing)} cached, "
+                       f"{len(missing)} captioned ({len(hash_of) - len(images)} duplicates), {failed} failed")
 
+    return IMAGE_LINK.sub(lambda match: replacements[match.group(2)], markdown), retryable == 0
 
-@mcp.tool()
-def extract_webpage(input: UrlInput) -> MarkdownOutput:
-    """Extract and convert webpage content to markdown. Usage: extract_webpage|input={"url": "https://example.com"}"""
 
-    downloaded = trafilatura.fetch_url(input.url)
+def webpage_to_markdown(url: str) -> str | None:
+    """Webpage text as markdown with its image links (None if the download failed)."""
+    downloaded = trafilatura.fetch_url(url)
     if not downloaded:
-        return MarkdownOutput(markdown="Failed to download the webpage.")
+        return None
 
-    markdown = trafilatura.extract(
+    return trafilatura.extract(
         downloaded,
         include_comments=False,
         include_tables=True,
@@ -199,7 +506,39 @@ def extract_webpage(input: UrlInput) -> MarkdownOutput:
         output_format='markdown'
     ) or ""
 
-    markdown = replace_images_with_captions(markdown)
+
+def pdf_to_markdown(file_path: str) -> str:
+    """PDF text as markdown; images stay in memory, embedded as base64 data URIs for captioning."""
+    return pymupdf4llm.to_markdown(file_path, embed_images=True)
+
+
+def extract_markdown(file_path: str) -> str:
+    """
+    Uncaptioned markdown for one document. CPU-bound, so process_documents runs it in
+    worker processes; image links are captioned afterwards in the main process.
+    """
+    file = Path(file_path)
+    ext = file.suffix.lower()
+    if ext == ".pdf":
+        mcp_log("INFO", f"Using MuPDF4LLM to extract {file.name}")
+        return pdf_to_markdown(file_path)
+    if ext in [".html", ".htm", ".url"]:
+        mcp_log("INFO", f"Using Trafilatura to extract {file.name}")
+        return webpage_to_markdown(file.read_text().strip()) or ""
+    # Fallback to MarkItDown for other formats
+    mcp_log("INFO", f"Using MarkItDown fallback for {file.name}")
+    return MarkItDown().convert(file_path).text_content
+
+
+@mcp.tool()
+def extract_webpage(input: UrlInput) -> MarkdownOutput:
+    """Extract and convert webpage content to markdown. Usage: extract_webpage|input={"url": "https://example.com"}"""
+
+    markdown = webpage_to_markdown(input.url)
+    if markdown is None:
+        return MarkdownOutput(markdown="Failed to download the webpage.")
+
+    markdown, _ = replace_images_with_captions(markdown)
     return MarkdownOutput(markdown=markdown)
 
 @mcp.tool()
@@ -209,28 +548,73 @@ def extract_pdf(input: FilePathInput) -> MarkdownOutput:
     if not os.path.exists(input.file_path):
         return MarkdownOutput(markdown=f"File not found: {input.file_path}")
 
-    ROOT = Path(__file__).parent.resolve()
-    global_image_dir = ROOT / "documents" / "images"
-    global_image_dir.mkdir(parents=True, exist_ok=True)
-
-    # Actual markdown with relative image paths
-    markdown = pymupdf4llm.to_markdown(
-        input.file_path,
-        write_images=True,
-        image_path=str(global_image_dir)
-    )
-
-    # Re-point image links in the markdown
-    markdown = re.sub(
-        r'!\[\]\((.*?/images/)([^)]+)\)',
-        r'![](images/\2)',
-        markdown.replace("\\", "/")
-    )
-
-    markdown = replace_images_with_captions(markdown)
+    markdown, _ = replace_images_with_captions(pdf_to_markdown(input.file_path))
     return MarkdownOutput(markdown=markdown)
 
 
+SENTENCE_END = re.compile(r'(?<=[.!?])\s+(?=["\'(\[*_]*[A-Z0-9])')
+STRUCTURED_BLOCK = re.compile(r'^\s*(\||```|[-*+] |\d+[.)] )')
+
+
+def segment_units(text: str) -> list[tuple[str, int, bool]]:
+    """
+    Markdown split into (unit, block number, is heading). Paragraphs are split into
+    sentences; tables, lists and code blocks stay whole (split by lines if oversized).
+    """
+    units = []
+    for block_no, block in enumerate(re.split(r'\n\s*\n', text)):
+        block = block.strip()
+        if not block:
+            continue
+        lines = block.splitlines()
+        if lines[0].lstrip().startswith("#"):
+            units.append((lines[0].strip(), block_no, True))
+            block = "\n".join(lines[1:]).strip()
+            if not block:
+                continue
+        if STRUCTURED_BLOCK.match(block):
+            pieces = [block] if len(block.split()) <= SEGMENT_MAX_WORDS else block.splitlines()
+        else:
+            pieces = SENTENCE_END.split(" ".join(block.split()))
+        for piece in pieces:
+            words = piece.split()
+            for start in range(0, len(words), SEGMENT_MAX_WORDS):
+                units.append((piece if len(words) <= SEGMENT_MAX_WORDS else " ".join(words[start:start + SEGMENT_MAX_WORDS]), block_no, False))
+    return units
+
+
+def embedding_segment(text: str) -> list[str]:
+    """
+    Splits text on markdown structure and sentence boundaries, then merges adjacent
+    sentences while they stay similar (cosine of batched embeddings) to the chunk
+    they'd join. Headings start a new chunk; chunks stay under SEGMENT_MAX_WORDS.
+    """
+    units = segment_units(text)
+    if len(units) <= 1:
+        return [unit for unit, _, _ in units]
+
+    vectors = get_embeddings([unit for unit, _, _ in units])
+    vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+    chunks = []
+    current, words, centroid, last_block, after_heading = "", 0, None, None, False
+    for (unit, block_no, heading), vector in zip(units, vectors):
+        size = len(unit.split())
+        if current:
+            similarity = float(centroid @ vector) / max(float(np.linalg.norm(centroid)), 1e-12)
+            if words + size > SEGMENT_MAX_WORDS or (words >= SEGMENT_MIN_WORDS and (heading or similarity < SEGMENT_SIMILARITY)):
+                chunks.append(current)
+                current, words, centroid = "", 0, None
+        separator = "\n\n" if block_no != last_block else "\n" if after_heading else " "
+        current += (separator if current else "") + unit
+        words += size
+        centroid = vector.copy() if centroid is None else centroid + vector
+        last_block, after_heading = block_no, heading
+    if current:
+        chunks.append(current)
+    return chunks
+
+
 def semantic_merge(text: str) -> list[str]:
     """Splits text semantically using LLM: detects second topic and reuses leftover intelligently."""
     WORD_LIMIT = 512
@@ -263,9 +647,12 @@ Keep markdown formatting intact.
             response = requests.post(OLLAMA_CHAT_URL, json={
                 "model": PHI_MODEL,
                 "messages": [{"role": "user", "content": prompt}],
-                "stream": False
+                "stream": False,
+                "keep_alive": KEEP_ALIVE
             })
-            reply = response.json().get("message", {}).get("content", "").strip()
+            data = response.json()
+            warmup.record(PHI_MODEL, data)
+            reply = data.get("message", {}).get("content", "").strip()
 
             if reply:
                 # If LLM returned second part, separate it
@@ -301,96 +688,221 @@ Keep markdown formatting intact.
 
 
 
-def process_documents():
+class StageStats:
+    """Items and time per ingestion stage, for the throughput report."""
+
+    def __init__(self):
+        self.stages = {}  # stage → {"unit", "items", "busy", "first", "last"}
+        self._lock = threading.Lock()  # captions are timed on the caption pool's threads
+
+    @contextmanager
+    def time(self, stage: str, unit: str, items: int = 1):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            with self._lock:
+                self._record(stage, unit, items, start, end)
+
+    def _record(self, stage: str, unit: str, items: int, start: float, end: float):
+        entry = self.stages.setdefault(stage, {"unit": unit, "items": 0, "busy": 0.0, "first": start, "last": end})
+        entry["items"] += items
+        entry["busy"] += end - start  # summed over concurrent tasks
+        entry["first"], entry["last"] = min(entry["first"], start), max(entry["last"], end)
+
+    def report(self, wall: float) -> str:
+        lines = [f"Ingestion finished in {wall:.1f}s"]
+        for stage, e in self.stages.items():
+            span = max(e["last"] - e["first"], 1e-9)
+            lines.append(
+                f"  {stage:<8} {e['items']:>5} {e['unit']:<7} busy {e['busy']:7.1f}s  "
+                f"span {span:7.1f}s  {e['items'] / span:8.2f} {e['unit']}/s"
+            )
+        return "\n".join(lines)
+
+
+def process_documents(segment_mode: str | None = None, reindex: bool = False):
     """Process documents and create FAISS index using unified multimodal strategy."""
-    mcp_log("INFO", "Indexing documents with unified RAG pipeline...")
-    ROOT = Path(__file__).parent.resolve()
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(ingest_documents(segment_mode or SEGMENT_MODE, reindex))
+    # Called from a tool, inside the server's event loop: run the pipeline on a loop of its own
+    with ThreadPoolExecutor(max_workers=1) as runner:
+        return runner.submit(asyncio.run, ingest_documents(segment_mode or SEGMENT_MODE, reindex)).result()
+
+
+def extraction_path(fhash: str) -> Path:
+    return EXTRACTION_CACHE / f"{fhash}-v{EXTRACTOR_VERSION}.md"
+
+
+def extraction_attempts_path(fhash: str) -> Path:
+    """Count of incomplete extractions of this file so far (removed once its extraction is cached)."""
+    return EXTRACTION_CACHE / f"{fhash}-v{EXTRACTOR_VERSION}.attempts"
+
+
+async def ingest_documents(segment_mode: str = SEGMENT_MODE, reindex: bool = False):
+    """
+    Staged ingestion: changed files are extracted in a process pool, then captioned,
+    segmented and embedded with bounded concurrency per model. Each file is committed
+    (chunk rows, then index) as soon as it's done, and a per-stage throughput report
+    is logged at the end. Captioned markdown is cached by file hash, so `reindex`
+    (re-chunk and re-embed every file, e.g. after changing segmentation) skips
+    extraction and captioning for files seen before.
+    """
+    if segment_mode not in ("embedding", "llm"):
+        raise ValueError(f"Unknown segmentation mode: {segment_mode} (expected embedding or llm)")
+    mcp_log("INFO", f"Indexing documents with unified RAG pipeline ({segment_mode} segmentation)...")
     DOC_PATH = ROOT / "documents"
     INDEX_CACHE = ROOT / "faiss_index"
     INDEX_CACHE.mkdir(exist_ok=True)
     INDEX_FILE = INDEX_CACHE / "index.bin"
-    METADATA_FILE = INDEX_CACHE / "metadata.json"
     CACHE_FILE = INDEX_CACHE / "doc_index_cache.json"
 
     def file_hash(path):
         return hashlib.md5(Path(path).read_bytes()).hexdigest()
 
     CACHE_META = json.loads(CACHE_FILE.read_text()) if CACHE_FILE.exists() else {}
-    metadata = json.loads(METADATA_FILE.read_text()) if METADATA_FILE.exists() else []
-    index = faiss.read_index(str(INDEX_FILE)) if INDEX_FILE.exists() else None
-
+    index = AdaptiveIndex.load(INDEX_FILE, **INDEX_CONFIG) if INDEX_FILE.exists() else AdaptiveIndex(**INDEX_CONFIG)
+    if index.migrated:
+        index.save(INDEX_FILE)
+
+    def replace_chunks(doc: str, new_chunks: list, embeddings: np.ndarray | None):
+        # Rows first (one transaction), then the index: stale vectors are removed
+        # (tombstoned on HNSW; a rebuild compacts them once they pile up)
+        stale_ids = chunk_store.replace_document(doc, new_chunks)
+        index.remove(np.array(stale_ids, dtype=np.int64))
+        if new_chunks:
+            index.add(embeddings, np.array([c["vector_id"] for c in new_chunks]))
+        if stale_ids:
+            mcp_log("INFO", f"Removed {len(stale_ids)} stale chunks of {doc}")
+
+    # Files deleted from documents/ take their chunks with them
+    present = {file.name for file in DOC_PATH.glob("*.*")}
+    for doc in sorted(set(chunk_store.documents()) | set(CACHE_META)):
+        if doc not in present:
+            replace_chunks(doc, [], None)
+            CACHE_META.pop(doc, None)
+            CACHE_FILE.write_text(json.dumps(CACHE_META, indent=2))
+            index.save(INDEX_FILE)
+            mcp_log("DEL", f"Dropped deleted file from the index: {doc}")
+
+    pending = []
     for file in DOC_PATH.glob("*.*"):
         fhash = file_hash(file)
-        if file.name in CACHE_META and CACHE_META[file.name] == fhash:
+        if not reindex and file.name in CACHE_META and CACHE_META[file.name] == fhash:
             mcp_log("SKIP", f"Skipping unchanged file: {file.name}")
             continue
+        pending.append((file, fhash))
+    if not pending:
+        return
+    if segment_mode == "llm":
+        await asyncio.to_thread(warm_model, PHI_MODEL)
+
+    stats = StageStats()
+    started = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    segment_slots = asyncio.Semaphore(SEGMENT_CONCURRENCY)
+    embed_slots = asyncio.Semaphore(EMBED_CONCURRENCY)
+
+    def commit(file: Path, fhash: str, chunks: list[str], embeddings: np.ndarray | None, complete: bool = True):
+        # Runs on the event loop thread, so commits never interleave
+        with stats.time("commit", "files"):
+            first_id = chunk_store.next_id()
+            new_chunks = [
+                {"vector_id": first_id + i, "chunk": chunk, "chunk_id": f"{file.stem}_{i}"}
+                for i, chunk in enumerate(chunks)
+            ]
+            replace_chunks(file.name, new_chunks, embeddings)
+            if complete:
+                CACHE_META[file.name] = fhash
+            else:
+                CACHE_META.pop(file.name, None)  # searchable now, retried (failed captions only) next run
+            CACHE_FILE.write_text(json.dumps(CACHE_META, indent=2))
+            index.save(INDEX_FILE)
+        mcp_log("SAVE", f"Saved FAISS index ({index.kind}, {index.ntotal} vectors) and metadata after processing {file.name}")
 
+    async def ingest(file: Path, fhash: str, pool: ProcessPoolExecutor):
         mcp_log("PROC", f"Processing: {file.name}")
         try:
-            ext = file.suffix.lower()
-            markdown = ""
-
-            if ext == ".pdf":
-                mcp_log("INFO", f"Using MuPDF4LLM to extract {file.name}")
-                markdown = extract_pdf(FilePathInput(file_path=str(file))).markdown
-
-            elif ext in [".html", ".htm", ".url"]:
-                mcp_log("INFO", f"Using Trafilatura to extract {file.name}")
-                markdown = extract_webpage(UrlInput(url=file.read_text().strip())).markdown
-
+            cached = extraction_path(fhash)
+            complete = True
+            if cached.exists():
+                with stats.time("cached", "files"):
+                    markdown = cached.read_text(encoding="utf-8")
+                mcp_log("INFO", f"Using cached extraction of {file.name}")
             else:
-                # Fallback to MarkItDown for other formats
-                converter = MarkItDown()
-                mcp_log("INFO", f"Using MarkItDown fallback for {file.name}")
-                markdown = converter.convert(str(file)).text_content
+                with stats.time("extract", "files"):
+                    markdown = await loop.run_in_executor(pool, extract_markdown, str(file))
+                markdown, complete = await asyncio.to_thread(replace_images_with_captions, markdown, stats)
+                EXTRACTION_CACHE.mkdir(parents=True, exist_ok=True)
+                attempts_path = extraction_attempts_path(fhash)
+                attempts = int(attempts_path.read_text()) + 1 if attempts_path.exists() else 1
+                if not complete and attempts >= EXTRACTION_ATTEMPTS:
+                    # Still failing (e.g. offline): keep the placeholders rather than redo the file on every start
+                    mcp_log("WARN", f"Caching the extraction of {file.name} with placeholders after {attempts} attempts")
+                    complete = True
+                if complete:
+                    cached.with_name(cached.name + ".tmp").write_text(markdown, encoding="utf-8")
+                    os.replace(cached.with_name(cached.name + ".tmp"), cached)
+                    attempts_path.unlink(missing_ok=True)
+                else:
+                    # Transient failures shouldn't outlive themselves: the next run retries the failed images
+                    attempts_path.write_text(str(attempts))
+                    mcp_log("WARN", f"Not caching the extraction of {file.name} yet: some images may load or caption "
+                                    f"on a later run (attempt {attempts} of {EXTRACTION_ATTEMPTS})")
 
             if not markdown.strip():
                 mcp_log("WARN", f"No content extracted from {file.name}")
-                continue
+                if file.name in CACHE_META:
+                    # Changed to nothing indexable: the old chunks are stale
+                    replace_chunks(file.name, [], None)
+                    CACHE_META.pop(file.name)
+                    CACHE_FILE.write_text(json.dumps(CACHE_META, indent=2))
+                    index.save(INDEX_FILE)
+                return
 
             if len(markdown.split()) < 10:
                 mcp_log("WARN", f"Content too short for semantic merge in {file.name} → Skipping chunking.")
                 chunks = [markdown.strip()]
-            else:
+            elif segment_mode == "llm":
                 mcp_log("INFO", f"Running semantic merge on {file.name} with {len(markdown.split())} words")
-                chunks = semantic_merge(markdown)
-
-
-            embeddings_for_file = []
-            new_metadata = []
-            for i, chunk in enumerate(tqdm(chunks, desc=f"Embedding {file.name}")):
-                embedding = get_embedding(chunk)
-                embeddings_for_file.append(embedding)
-                new_metadata.append({
-                    "doc": file.name,
-                    "chunk": chunk,
-                    "chunk_id": f"{file.stem}_{i}"
-                })
-
-            if embeddings_for_file:
-                if index is None:
-                    dim = len(embeddings_for_file[0])
-                    index = faiss.IndexFlatL2(dim)
-                index.add(np.stack(embeddings_for_file))
-                metadata.extend(new_metadata)
-                CACHE_META[file.name] = fhash
+                async with segment_slots:
+                    with stats.time("segment", "files"):
+                        chunks = await asyncio.to_thread(semantic_merge, markdown)
+            else:
+                mcp_log("INFO", f"Segmenting {file.name} ({len(markdown.split())} words) by sentence similarity")
+                async with embed_slots:
+                    with stats.time("segment", "files"):
+                        chunks = await asyncio.to_thread(embedding_segment, markdown)
+            chunks = [chunk for chunk in chunks if chunk.strip()]
+            if not chunks:
+                return
 
-                # ✅ Immediately save index and metadata
-                CACHE_FILE.write_text(json.dumps(CACHE_META, indent=2))
-                METADATA_FILE.write_text(json.dumps(metadata, indent=2))
-                faiss.write_index(index, str(INDEX_FILE))
-                mcp_log("SAVE", f"Saved FAISS index and metadata after processing {file.name}")
+            async with embed_slots:
+                with stats.time("embed", "chunks", len(chunks)):
+                    embeddings = await asyncio.to_thread(get_embeddings, chunks)
+
+            # ✅ Immediately save this file's chunks (replacing any from an older version), then the index
+            commit(file, fhash, chunks, embeddings, complete)
 
         except Exception as e:
             mcp_log("ERROR", f"Failed to process {file.name}: {e}")
 
+    # Spawned, not forked: this process already runs the server thread and holds SQLite connections
+    workers = max(1, min(EXTRACT_WORKERS, len(pending)))
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        await asyncio.gather(*(ingest(file, fhash, pool) for file, fhash in pending))
+
+    mcp_log("STATS", stats.report(time.perf_counter() - started))
+
 
 
 def ensure_faiss_ready():
     from pathlib import Path
     index_path = ROOT / "faiss_index" / "index.bin"
-    meta_path = ROOT / "faiss_index" / "metadata.json"
-    if not (index_path.exists() and meta_path.exists()):
+    if not (index_path.exists() and chunk_store.count()):
         mcp_log("INFO", "Index not found — running process_documents()...")
         process_documents()
     else:
@@ -404,16 +916,23 @@ if __name__ == "__main__":
         mcp.run() # Run without transport for dev server
     else:
         # Start the server in a separate thread
-        import threading
         server_thread = threading.Thread(target=lambda: mcp.run(transport="stdio"))
         server_thread.daemon = True
         server_thread.start()
         
         # Wait a moment for the server to start
         time.sleep(2)
-        
-        # Process documents after server is running
-        process_documents()
+
+        # Preload the embedding model; segmentation and captioning models load only if indexing needs them
+        warmup.warmup()
+        mcp_log("INFO", f"Model status: {warmup.status()}")
+
+        # Process documents after server is running; --segment llm opts into semantic_merge for this run,
+        # --reindex re-chunks and re-embeds unchanged files too (from cached extractions)
+        process_documents(
+            sys.argv[sys.argv.index("--segment") + 1] if "--segment" in sys.argv else None,
+            reindex="--reindex" in sys.argv
+        )
         
         # Keep the main thread alive
         try:
@@ -1,8 +1,9 @@
 # modules/action.py
 
-from typing import Dict, Any, Union
+from typing import Dict, Any, List, Literal, Optional, Union
 from pydantic import BaseModel
 import ast
+import json
 
 from config.log_config import setup_logging
 
@@ -27,6 +28,55 @@ class ToolCallResult(BaseModel):
     raw_response: Any
 
 
+class ToolArgument(BaseModel):
+    name: str   # nested keys use dots, e.g. input.string
+    value: str  # JSON / Python literal, or plain text
+
+
+class PlannedAction(BaseModel):
+    """Structured plan returned by the LLM in JSON output mode."""
+    action: Literal["function_call", "final_answer"]
+    tool_name: Optional[str] = None
+    arguments: List[ToolArgument] = []
+    final_answer: Optional[str] = None
+
+    def to_arguments(self) -> Dict[str, Any]:
+        args = {}
+        for argument in self.arguments:
+            set_argument(args, argument.name, argument.value, json_values=True)
+        return args
+
+    def __str__(self) -> str:
+        if self.action == "final_answer":
+            return f"FINAL_ANSWER: {self.final_answer}"
+        return f"FUNCTION_CALL: {self.tool_name} {json.dumps(self.to_arguments(), ensure_ascii=False)}"
+
+
+def parse_value(raw: str, json_values: bool = False) -> Any:
+    """
+    Python literal, else the plain string. With `json_values` (PlannedAction arguments,
+    which the schema asks to write as JSON) JSON is tried first, so true/false/null and
+    JSON objects decode; FUNCTION_CALL text keeps those as strings.
+    """
+    raw = raw.strip()
+    parsers = (json.loads, ast.literal_eval) if json_values else (ast.literal_eval,)
+    for parser in parsers:
+        try:
+            return parser(raw)
+        except Exception:
+            continue
+    return raw
+
+
+def set_argument(args: Dict[str, Any], key: str, raw_value: str, json_values: bool = False):
+    """Stores `raw_value` under a possibly nested key (e.g., input.value)."""
+    keys = key.strip().split(".")
+    current = args
+    for k in keys[:-1]:
+        current = current.setdefault(k, {})
+    current[keys[-1]] = parse_value(raw_value, json_values)
+
+
 def parse_function_call(response: str) -> tuple[str, Dict[str, Any]]:
     """
     Parses a FUNCTION_CALL string like:
@@ -46,19 +96,7 @@ def parse_function_call(response: str) -> tuple[str, Dict[str, Any]]:
             if "=" not in part:
                 raise ValueError(f"Invalid parameter: {part}")
             key, val = part.split("=", 1)
-
-            # Try parsing as literal, fallback to string
-            try:
-                parsed_val = ast.literal_eval(val)
-            except Exception:
-                parsed_val = val.strip()
-
-            # Support nested keys (e.g., input.value)
-            keys = key.split(".")
-            current = args
-            for k in keys[:-1]:
-                current = current.setdefault(k, {})
-            current[keys[-1]] = parsed_val
+            set_argument(args, key, val)
 
         log("parser", f"Parsed: {tool_name} → {args}")
         return tool_name, args
@@ -0,0 +1,70 @@
+# modules/caption_cache.py → Caption Cache
+# Role: Image captions on disk, keyed by image content, so re-indexing never captions the same image twice.
+
+# Responsibilities:
+
+# Key captions by (SHA-256 of the image bytes, captioning model)
+
+# Look up many images in one query; store each caption as it arrives
+
+# Dependencies:
+
+# sqlite3
+
+# Used by: mcp_server_2.py (document ingestion)
+
+# modules/caption_cache.py
+
+from typing import Dict, List
+from pathlib import Path
+import hashlib
+import sqlite3
+import threading
+import time
+
+CACHE_DIR = Path(__file__).parent.parent / "cache"
+
+
+def image_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+class CaptionCache:
+    def __init__(self, path: Path = CACHE_DIR / "captions.sqlite"):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS captions (
+                hash TEXT NOT NULL, model TEXT NOT NULL, caption TEXT NOT NULL, created REAL NOT NULL,
+                PRIMARY KEY (hash, model)
+            )""")
+        self.db.commit()
+
+    def get_many(self, hashes: List[str], model: str) -> Dict[str, str]:
+        """Cached captions for the given image hashes (missing ones are left out)."""
+        found = {}
+        with self._lock:
+            for start in range(0, len(hashes), 500):
+                batch = hashes[start:start + 500]
+                found.update(self.db.execute(
+                    f"SELECT hash, caption FROM captions WHERE model = ? AND hash IN ({','.join('?' * len(batch))})",
+                    [model, *batch]
+                ).fetchall())
+        self.hits += len(found)
+        self.misses += len(set(hashes)) - len(found)
+        return found
+
+    def put(self, digest: str, model: str, caption: str):
+        with self._lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO captions (hash, model, caption, created) VALUES (?, ?, ?, ?)",
+                (digest, model, caption, time.time())
+            )
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses}
@@ -0,0 +1,158 @@
+# modules/chunk_store.py → Chunk Store
+# Role: SQLite store of document chunk metadata, keyed by FAISS vector id.
+
+# Responsibilities:
+
+# Hold one row per indexed chunk (vector id, document, chunk id, chunk text)
+
+# Replace or delete a document's chunks in one transaction, so indexing writes only
+# what changed and returns the stale vector ids for the caller to remove from the index
+
+# Fetch just the rows for the ids a search returned
+
+# Keyword search: an FTS5 inverted index over the chunk text, ranked by BM25, kept in
+# step with the chunk rows (same transactions); stopwords are left out of queries
+
+# Import the legacy metadata.json (vector id = list position) once
+
+# Dependencies:
+
+# sqlite3 (with FTS5, bundled with Python's SQLite builds)
+
+# Used by: mcp_server_2.py (document index)
+
+# modules/chunk_store.py
+
+from typing import Dict, Iterable, List, Tuple
+from pathlib import Path
+import json
+import re
+import sqlite3
+import threading
+
+# Left out of keyword queries: they match nearly every chunk and would let any question
+# return k "hits" (English function words plus common question words)
+STOPWORDS = frozenset("""
+a about after all also an and any are as at be been before being between both but by can could did do does
+each few for from had has have how i if in into is it its me more most my no nor not of on only or other our
+out over own same shall should so some such than that the their them then there these they this to too
+under until up very was we were what when where which who whom why will with would you your
+""".split())
+
+
+class ChunkStore:
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS chunks (
+                vector_id INTEGER PRIMARY KEY, doc TEXT NOT NULL, chunk_id TEXT NOT NULL, chunk TEXT NOT NULL
+            )""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS chunks_doc ON chunks (doc)")
+        # Ids of removed chunks are never handed out again (HNSW keeps them as tombstones until a rebuild)
+        self.db.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        # Inverted index for BM25; rowid = vector id
+        self.db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS chunks_fts USING fts5(chunk)")
+        self.db.commit()
+        self._backfill_text_index()
+
+    def _backfill_text_index(self):
+        # Stores written before the keyword index existed
+        with self._lock, self.db:
+            indexed = self.db.execute("SELECT COUNT(*) FROM chunks_fts").fetchone()[0]
+            if indexed != self.db.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]:
+                self.db.execute("DELETE FROM chunks_fts")
+                self.db.execute("INSERT INTO chunks_fts (rowid, chunk) SELECT vector_id, chunk FROM chunks")
+
+    def _insert(self, rows: List[Tuple[int, str, str, str]]) -> int:
+        inserted = self.db.executemany("INSERT INTO chunks (vector_id, doc, chunk_id, chunk) VALUES (?, ?, ?, ?)", rows).rowcount
+        self.db.executemany("INSERT INTO chunks_fts (rowid, chunk) VALUES (?, ?)", [(row[0], row[3]) for row in rows])
+        return max(inserted, 0)
+
+    def import_json(self, metadata_path: Path) -> int:
+        """
+        Moves a legacy metadata.json into the store (its list positions were the vector
+        ids) and renames it to metadata.json.migrated. Returns the number of rows actually
+        inserted (0 if the store already had rows).
+        """
+        metadata_path = Path(metadata_path)
+        if not metadata_path.exists():
+            return 0
+        metadata = json.loads(metadata_path.read_text())
+        inserted = 0
+        with self._lock, self.db:
+            if self.db.execute("SELECT COUNT(*) FROM chunks").fetchone()[0] == 0:
+                inserted = self._insert([(i, row["doc"], row["chunk_id"], row["chunk"]) for i, row in enumerate(metadata)])
+        metadata_path.replace(metadata_path.with_name(metadata_path.name + ".migrated"))
+        return inserted
+
+    def next_id(self) -> int:
+        with self._lock:
+            return self._next_id()
+
+    def _next_id(self) -> int:
+        highest = self.db.execute("SELECT MAX(vector_id) FROM chunks").fetchone()[0]
+        counter = self.db.execute("SELECT value FROM counters WHERE name = 'next_vector_id'").fetchone()
+        return max(highest + 1 if highest is not None else 0, counter[0] if counter else 0)
+
+    def count(self) -> int:
+        with self._lock:
+            return self.db.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def documents(self) -> List[str]:
+        with self._lock:
+            return [row[0] for row in self.db.execute("SELECT DISTINCT doc FROM chunks")]
+
+    def replace_document(self, doc: str, chunks: List[Dict]) -> List[int]:
+        """
+        Swaps a document's chunks for `chunks` ({"vector_id", "chunk_id", "chunk"}) in one
+        transaction. Returns the vector ids of the rows it replaced.
+        """
+        with self._lock, self.db:
+            next_id = self._next_id()
+            old_ids = [row[0] for row in self.db.execute("SELECT vector_id FROM chunks WHERE doc = ?", (doc,))]
+            self.db.execute("DELETE FROM chunks WHERE doc = ?", (doc,))
+            self.db.executemany("DELETE FROM chunks_fts WHERE rowid = ?", [(i,) for i in old_ids])
+            self._insert([(int(c["vector_id"]), doc, c["chunk_id"], c["chunk"]) for c in chunks])
+            next_id = max([next_id] + [int(c["vector_id"]) + 1 for c in chunks])
+            self.db.execute("INSERT OR REPLACE INTO counters (name, value) VALUES ('next_vector_id', ?)", (next_id,))
+        return old_ids
+
+    def delete_document(self, doc: str) -> List[int]:
+        """Drops a document's chunks; returns their vector ids."""
+        return self.replace_document(doc, [])
+
+    def get(self, vector_ids: Iterable[int]) -> Dict[int, Dict]:
+        """Rows for the given vector ids; ids without a row (not committed yet) are left out."""
+        vector_ids = [int(i) for i in vector_ids]
+        if not vector_ids:
+            return {}
+        with self._lock:
+            rows = self.db.execute(
+                f"SELECT vector_id, doc, chunk_id, chunk FROM chunks WHERE vector_id IN ({','.join('?' * len(vector_ids))})",
+                vector_ids
+            ).fetchall()
+        return {row["vector_id"]: dict(row) for row in rows}
+
+    def search_text(self, query: str, k: int, min_score: float = 0.0) -> List[Tuple[int, float]]:
+        """
+        BM25 keyword search: (vector id, score) for the k best chunks sharing any
+        non-stopword term with the query and scoring at least `min_score`, best first
+        (higher is better).
+        """
+        terms = [term for term in dict.fromkeys(re.findall(r"\w+", query.lower())) if term not in STOPWORDS]
+        if not terms:
+            return []
+        # Each term quoted, so FTS5 syntax in the query ("-", ":", AND...) is taken literally
+        expression = " OR ".join(f'"{term}"' for term in terms)
+        with self._lock:
+            rows = self.db.execute(
+                "SELECT rowid, bm25(chunks_fts) FROM chunks_fts WHERE chunks_fts MATCH ? AND bm25(chunks_fts) <= ? "
+                "ORDER BY bm25(chunks_fts) LIMIT ?",
+                (expression, -min_score, k)
+            ).fetchall()
+        return [(row[0], -row[1]) for row in rows]
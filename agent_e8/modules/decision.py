@@ -1,6 +1,7 @@
-from typing import List, Optional
+from typing import List, Optional, Union
 from modules.perception import PerceptionResult
 from modules.memory import MemoryItem
+from modules.action import PlannedAction
 from modules.model_manager import ModelManager
 from dotenv import load_dotenv
 from google import genai
@@ -17,6 +18,61 @@ except ImportError:
         print(f"[{now}] [{stage}] {msg}")
 
 model = ModelManager()
+STRUCTURED_OUTPUT = model.profile["llm"].get("structured_output", False)
+
+# Response instructions appended to the planning prompt, per output mode
+TEXT_RESPONSE_FORMAT = """
+Respond in **exactly one line** using one of the following formats:
+
+- FUNCTION_CALL: tool_name|param1=value1|param2=value2
+- FINAL_ANSWER: [your final result] *(Not description, but actual final answer)
+
+✅ Examples:
+- FUNCTION_CALL: add|input.a=5|input.b=3
+- FUNCTION_CALL: strings_to_chars_to_int|input.string=INDIA
+- FUNCTION_CALL: int_list_to_exponential_sum|input.int_list=[73,78,68,73,65]
+- FINAL_ANSWER: [42] → Always mention final answer to the query, not that some other description.
+Follow the examples, and look into the error messages to improve the plan.
+
+✅ Examples:
+- User asks: "What’s the relationship between Cricket and Sachin Tendulkar"
+  - FUNCTION_CALL: search_documents|query="relationship between Cricket and Sachin Tendulkar"
+  - [receives a detailed document]
+  - FINAL_ANSWER: [Sachin Tendulkar is widely regarded as the "God of Cricket" due to his exceptional skills, longevity, and impact on the sport in India. He is the leading run-scorer in both Test and ODI cricket, and the first to score 100 centuries in international cricket. His influence extends beyond his statistics, as he is seen as a symbol of passion, perseverance, and a national icon. ]
+
+---
+
+📏 IMPORTANT Rules: YOU MUST FOLLOW THESE RULES STRICTLY.
+
+
+VERY IMPORTANT RULE:
+- ❌ NEVER NEVER USE "|" inside argument values for function calls; if you encounter argument values with "|" especially in the list format, dealing with emails, web content etc., you MUST CHOOSE ALTERNATE SEPERATOR OR FORMATs
+For Example:
+
+NEVER SEND THIS:
+1. Max Verstappen - 437 | Lando Norris - 374
+
+SEND THIS INSTEAD:
+
+  1. Max Verstappen - 437
+  2. Lando Norris - 374
+  ...
+"""
+
+JSON_RESPONSE_FORMAT = """
+Respond with one JSON object matching the response schema:
+- action: "function_call" or "final_answer"
+- tool_name: the tool to call (function_call only)
+- arguments: list of {"name": ..., "value": ...} pairs. Use nested names like `input.string` or `input.int_list`; write lists and objects as JSON (e.g. "[73,78,68,73,65]"). Values may contain any text, including "|" and newlines.
+- final_answer: your actual final result, not a description (final_answer only)
+
+✅ Examples:
+- {"action": "function_call", "tool_name": "add", "arguments": [{"name": "input.a", "value": "5"}, {"name": "input.b", "value": "3"}]}
+- {"action": "function_call", "tool_name": "strings_to_chars_to_int", "arguments": [{"name": "input.string", "value": "INDIA"}]}
+- {"action": "function_call", "tool_name": "search_documents", "arguments": [{"name": "query", "value": "relationship between Cricket and Sachin Tendulkar"}]}
+- {"action": "final_answer", "final_answer": "[42]"}
+Follow the examples, and look into the error messages to improve the plan.
+"""
 
 
 async def generate_plan(
@@ -24,12 +80,19 @@ async def generate_plan(
     memory_items: List[MemoryItem],
     tool_descriptions: Optional[str] = None,
     step_num: int = 1,
-    max_steps: int = 3
-) -> str:
-    """Generates the next step plan for the agent: either tool usage or final answer."""
+    max_steps: int = 3,
+    session_id: Optional[str] = None
+) -> Union[str, PlannedAction]:
+    """
+    Generates the next step plan for the agent: either tool usage or final answer.
+    When `session_id` is given, the prompt opens a conversation that later steps
+    continue via `continue_plan()`. In structured output mode the plan comes back
+    as a validated `PlannedAction` instead of a FUNCTION_CALL / FINAL_ANSWER line.
+    """
 
     memory_texts = "\n".join(f"- {m.text}" for m in memory_items) or "None"
     tool_context = f"\nYou have access to the following tools:\n{tool_descriptions}" if tool_descriptions else ""
+    response_format = JSON_RESPONSE_FORMAT if STRUCTURED_OUTPUT else TEXT_RESPONSE_FORMAT
 
     prompt = f"""
 Role:
@@ -102,56 +165,90 @@ Here is some additional context to help you:
 
 You are currently at step: {step_num} of {max_steps}
 
-Respond in **exactly one line** using one of the following formats:
+{response_format}
+"""
 
-- FUNCTION_CALL: tool_name|param1=value1|param2=value2
-- FINAL_ANSWER: [your final result] *(Not description, but actual final answer)
+    # ✂️ Least relevant memory goes first, then the task text carrying the last tool output
+    memory_lines = [f"- {m.text}" for m in memory_items]
+    prompt = model.enforce_budget("plan", prompt, list(reversed(memory_lines)) + [perception.user_input])
 
-✅ Examples:
-- FUNCTION_CALL: add|input.a=5|input.b=3
-- FUNCTION_CALL: strings_to_chars_to_int|input.string=INDIA
-- FUNCTION_CALL: int_list_to_exponential_sum|input.int_list=[73,78,68,73,65]
-- FINAL_ANSWER: [42] → Always mention final answer to the query, not that some other description.
-Follow the examples, and look into the error messages to improve the plan.
+    #print(f"plan prompt: {prompt}")
 
-✅ Examples:
-- User asks: "What’s the relationship between Cricket and Sachin Tendulkar"
-  - FUNCTION_CALL: search_documents|query="relationship between Cricket and Sachin Tendulkar"
-  - [receives a detailed document]
-  - FINAL_ANSWER: [Sachin Tendulkar is widely regarded as the "God of Cricket" due to his exceptional skills, longevity, and impact on the sport in India. He is the leading run-scorer in both Test and ODI cricket, and the first to score 100 centuries in international cricket. His influence extends beyond his statistics, as he is seen as a symbol of passion, perseverance, and a national icon. ]
+    try:
+        if session_id:
+            model.end_chat(session_id)
+
+        if STRUCTURED_OUTPUT:
+            if session_id:
+                plan = await model.chat_json(session_id, prompt, PlannedAction)
+            else:
+                plan = await model.generate_json(prompt, PlannedAction, stage="plan")
+            log("plan", f"LLM output: {plan.model_dump_json()}")
+            return plan
+
+        if session_id:
+            raw = (await model.chat(session_id, prompt)).strip()
+        else:
+            raw = (await model.generate_text(prompt, stage="plan")).strip()
+        log("plan", f"LLM output: {raw}")
+        return extract_plan_line(raw)
 
----
+    except Exception as e:
+        log("plan", f"⚠️ Planning failed: {e}")
+        return "FINAL_ANSWER: [unknown]"
 
-📏 IMPORTANT Rules: YOU MUST FOLLOW THESE RULES STRICTLY.
 
+async def continue_plan(
+    session_id: str,
+    last_result: str,
+    step_num: int,
+    max_steps: int
+) -> Union[str, PlannedAction]:
+    """Sends only the latest tool result into the session's planning conversation."""
 
-VERY IMPORTANT RULE:
-- ❌ NEVER NEVER USE "|" inside argument values for function calls; if you encounter argument values with "|" especially in the list format, dealing with emails, web content etc., you MUST CHOOSE ALTERNATE SEPERATOR OR FORMATs
-For Example:
+    if STRUCTURED_OUTPUT:
+        next_step = """If this fully answers the task, respond with action "final_answer".
 
-NEVER SEND THIS:
-1. Max Verstappen - 437 | Lando Norris - 374
+Otherwise, respond with the next "function_call", following the same rules as before."""
+    else:
+        next_step = """If this fully answers the task, return:
+FINAL_ANSWER: your answer
 
-SEND THIS INSTEAD:
+Otherwise, return the next FUNCTION_CALL, in exactly one line, following the same rules as before."""
 
-  1. Max Verstappen - 437
-  2. Lando Norris - 374
-  ...
-"""
+    message = f"""Your last tool produced this result:
 
-    #print(f"plan prompt: {prompt}")
+{last_result}
 
-    try:
-        raw = (await model.generate_text(prompt)).strip()
-        log("plan", f"LLM output: {raw}")
+You are currently at step: {step_num} of {max_steps}
 
-        for line in raw.splitlines():
-            if line.strip().startswith("FUNCTION_CALL:") or line.strip().startswith("FINAL_ANSWER:"):
-                return line.strip()
+{next_step}"""
+    message = model.enforce_budget("plan_step", message, [last_result])
 
-        return "FINAL_ANSWER: [unknown]"
+    try:
+        if STRUCTURED_OUTPUT:
+            plan = await model.chat_json(session_id, message, PlannedAction, stage="plan_step")
+            log("plan", f"LLM output: {plan.model_dump_json()}")
+            return plan
+
+        raw = (await model.chat(session_id, message, stage="plan_step")).strip()
+        log("plan", f"LLM output: {raw}")
+        return extract_plan_line(raw)
 
     except Exception as e:
         log("plan", f"⚠️ Planning failed: {e}")
         return "FINAL_ANSWER: [unknown]"
 
+
+def end_chat(session_id: str):
+    """Drops the planning conversation once the agent session is over."""
+    model.end_chat(session_id)
+
+
+def extract_plan_line(raw: str) -> str:
+    for line in raw.splitlines():
+        if line.strip().startswith("FUNCTION_CALL:") or line.strip().startswith("FINAL_ANSWER:"):
+            return line.strip()
+
+    return "FINAL_ANSWER: [unknown]"
+
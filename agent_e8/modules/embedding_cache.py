@@ -0,0 +1,181 @@
+# modules/embedding_cache.py → Embedding Cache
+# Role: Content-addressed cache of text embeddings, shared across processes.
+
+# Responsibilities:
+
+# Key embeddings by (space, SHA-256 of normalized text)
+
+# Keep vectors in one mmap'd float32 file per space, slots indexed in SQLite
+
+# Evict least recently used entries once a space is full
+
+# Dependencies:
+
+# numpy, sqlite3
+
+# Used by: memory.py (agent memory), mcp_server_2.py (document search / indexing)
+
+# modules/embedding_cache.py
+
+from typing import Callable, List, Optional
+from pathlib import Path
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+import numpy as np
+
+CACHE_DIR = Path(__file__).parent.parent / "cache" / "embeddings"
+
+
+def normalize_text(text: str) -> str:
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFC", text)).strip()
+
+
+def text_key(text: str) -> str:
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    One cache "space" per embedding model + endpoint, e.g. "nomic-embed-text:embed".
+    Vectors from different endpoints of the same model differ (Ollama's /api/embed
+    normalizes, /api/embeddings doesn't), so they must not share a space.
+    """
+
+    def __init__(self, space: str, cache_dir: Path = CACHE_DIR, capacity: int = 50000):
+        self.space = space
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.capacity = capacity
+        self.vector_path = self.cache_dir / f"{re.sub(r'[^A-Za-z0-9_.-]', '_', space)}.f32"
+        self.vectors: Optional[np.memmap] = None
+        self.dim: Optional[int] = None
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        self.db = sqlite3.connect(self.cache_dir / "index.sqlite", timeout=30, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS spaces (
+                space TEXT PRIMARY KEY, dim INTEGER NOT NULL, capacity INTEGER NOT NULL
+            )""")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS entries (
+                space TEXT NOT NULL, key TEXT NOT NULL, slot INTEGER NOT NULL, last_used REAL NOT NULL,
+                PRIMARY KEY (space, key)
+            )""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS entries_lru ON entries (space, last_used)")
+        self.db.commit()
+
+        row = self.db.execute("SELECT dim, capacity FROM spaces WHERE space = ?", (space,)).fetchone()
+        if row and self.vector_path.exists():
+            self._open(*row)
+
+    def _open(self, dim: int, capacity: int):
+        mode = "r+" if self.vector_path.exists() else "w+"
+        self.vectors = np.memmap(self.vector_path, dtype=np.float32, mode=mode, shape=(capacity, dim))
+        self.dim, self.capacity = dim, capacity
+
+    def get_many(self, texts: List[str]) -> List[Optional[np.ndarray]]:
+        keys = [text_key(t) for t in texts]
+        if self.vectors is None:
+            self.misses += len(keys)
+            return [None] * len(keys)
+
+        with self._lock:
+            slots = {}
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                rows = self.db.execute(
+                    f"SELECT key, slot FROM entries WHERE space = ? AND key IN ({','.join('?' * len(batch))})",
+                    [self.space, *batch]
+                ).fetchall()
+                slots.update(rows)
+            if slots:
+                now = time.time()
+                self.db.executemany(
+                    "UPDATE entries SET last_used = ? WHERE space = ? AND key = ?",
+                    [(now, self.space, key) for key in slots]
+                )
+                self.db.commit()
+
+        results = [np.array(self.vectors[slots[key]]) if key in slots else None for key in keys]
+        found = sum(r is not None for r in results)
+        self.hits += found
+        self.misses += len(results) - found
+        return results
+
+    def put_many(self, texts: List[str], vectors: np.ndarray):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if len(texts) == 0:
+            return
+
+        with self._lock:
+            # BEGIN IMMEDIATE serializes slot allocation across processes sharing the cache
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                if self.vectors is None:
+                    self.db.execute(
+                        "INSERT OR IGNORE INTO spaces (space, dim, capacity) VALUES (?, ?, ?)",
+                        (self.space, vectors.shape[1], self.capacity)
+                    )
+                    self._open(*self.db.execute(
+                        "SELECT dim, capacity FROM spaces WHERE space = ?", (self.space,)
+                    ).fetchone())
+
+                count = self.db.execute("SELECT COUNT(*) FROM entries WHERE space = ?", (self.space,)).fetchone()[0]
+                now = time.time()
+                for text, vector in zip(texts, vectors):
+                    key = text_key(text)
+                    row = self.db.execute(
+                        "SELECT slot FROM entries WHERE space = ? AND key = ?", (self.space, key)
+                    ).fetchone()
+                    if row:
+                        continue
+
+                    if count < self.capacity:
+                        # Slots stay dense: entries are only ever replaced, never deleted
+                        slot = count
+                        count += 1
+                        self.vectors[slot] = vector
+                        self.db.execute(
+                            "INSERT INTO entries (space, key, slot, last_used) VALUES (?, ?, ?, ?)",
+                            (self.space, key, slot, now)
+                        )
+                    else:
+                        old_key, slot = self.db.execute(
+                            "SELECT key, slot FROM entries WHERE space = ? ORDER BY last_used LIMIT 1",
+                            (self.space,)
+                        ).fetchone()
+                        self.vectors[slot] = vector
+                        self.db.execute(
+                            "UPDATE entries SET key = ?, last_used = ? WHERE space = ? AND key = ?",
+                            (key, now, self.space, old_key)
+                        )
+
+                self.vectors.flush()
+                self.db.commit()
+            except Exception:
+                self.db.rollback()
+                raise
+
+    def embed(self, texts: List[str], embed_fn: Callable[[List[str]], np.ndarray]) -> np.ndarray:
+        """
+        Returns embeddings for `texts` (len(texts), dim), calling `embed_fn` only
+        for the texts that aren't cached yet (each distinct text once).
+        """
+        cached = self.get_many(texts)
+        missing = list(dict.fromkeys(t for t, v in zip(texts, cached) if v is None))
+        if missing:
+            fresh = np.asarray(embed_fn(missing), dtype=np.float32)
+            self.put_many(missing, fresh)
+            by_text = dict(zip(missing, fresh))
+            cached = [v if v is not None else by_text[t] for t, v in zip(texts, cached)]
+        return np.stack(cached) if cached else np.zeros((0, self.dim or 0), dtype=np.float32)
+
+    def stats(self) -> dict:
+        return {"space": self.space, "hits": self.hits, "misses": self.misses, "dim": self.dim, "capacity": self.capacity}
@@ -7,7 +7,25 @@
 
 # Use local embedding server (e.g., Ollama) to vectorize input
 
-# Filter memory based on type/tags/session
+# Filter memory based on type/tags/session inside the search (per-type/tag/session id sets)
+
+# Index starts flat and upgrades to HNSW / IVF as memory grows (vector_index.py)
+
+# Persist the index (faiss.write_index) and items (append-only JSONL)
+# so memory survives across sessions; one shared instance per process
+
+# Keep memory bounded: near-duplicates replace older items, items expire by type,
+# and per-session / global caps evict by LRU or LFU
+
+# Split large outputs into bounded chunks linked to an unembedded parent record;
+# retrieval returns the matching chunks
+
+# Find earlier results of the same (or an equivalent) tool call, so the loop can skip re-running it
+
+# Score by cosine similarity (normalized inner product) and drop matches below min_score
+
+# Hold metadata compactly (__slots__ records, interned strings); vectors live only
+# in the FAISS index. MemoryItem objects are built just for returned results
 
 # Dependencies:
 
@@ -21,49 +39,435 @@
 
 # modules/memory.py
 
-from typing import List, Optional, Literal
-from pydantic import BaseModel
-from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Literal, Set, Tuple
+from pydantic import BaseModel, Field
+from datetime import datetime, timedelta
+from pathlib import Path
+import json
+import os
+import re
+import sys
+import time
 import requests
 import numpy as np
-import faiss
+from modules.warmup import ollama_warmup
+from modules.embedding_cache import EmbeddingCache
+from modules.vector_index import AdaptiveIndex
+
+COMPACTION_DEFAULTS = {
+    "dedupe_threshold": 0.97,       # cosine similarity; None disables deduplication
+    "ttl_days": {},                 # type → max age in days
+    "max_items_per_session": None,
+    "max_items": None,
+    "eviction": "lru",              # lru | lfu
+    "protected_types": ["preference", "system"],  # never evicted by the caps
+    "every": 50,                    # compact after this many adds
+}
+
+CHUNKING_DEFAULTS = {
+    "max_chars": 1200,     # texts longer than this are stored as chunks of at most this size
+    "overlap_chars": 150,  # shared between consecutive chunks so a match isn't cut in half
+}
 
 
 class MemoryItem(BaseModel):
+    id: Optional[int] = None  # assigned by MemoryManager; also the vector id in the index
     text: str
     type: Literal["preference", "tool_output", "fact", "query", "system"] = "fact"
-    timestamp: Optional[str] = datetime.now().isoformat()
+    timestamp: Optional[str] = Field(default_factory=lambda: datetime.now().isoformat())
     tool_name: Optional[str] = None
     user_query: Optional[str] = None
     tags: List[str] = []
     session_id: Optional[str] = None
+    score: Optional[float] = None  # similarity to the query; only set on retrieved items
+    parent_id: Optional[int] = None   # chunks: id of the full text they were split from
+    chunk_index: Optional[int] = None
+    chunks: Optional[int] = None      # parents: number of chunks (parents aren't embedded)
+    call_key: Optional[str] = None    # tool outputs: canonical form of the call, see call_key()
+
+
+def created_at(timestamp: Optional[str]) -> float:
+    try:
+        return datetime.fromisoformat(timestamp).timestamp()
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _intern(value: Optional[str]) -> Optional[str]:
+    return sys.intern(value) if value is not None else None
+
+
+def call_key(tool_name: str, arguments) -> str:
+    """Canonical tool call: sorted-key JSON of the arguments with whitespace collapsed in strings."""
+    def normalize(value):
+        if isinstance(value, str):
+            return " ".join(value.split())
+        if isinstance(value, dict):
+            return {str(k): normalize(v) for k, v in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [normalize(v) for v in value]
+        return value
+    return f"{tool_name}:{json.dumps(normalize(arguments), sort_keys=True, default=str)}"
+
+
+def call_signature(tool_name: str, arguments) -> str:
+    """Readable form of a tool call, embedded to find semantically equivalent calls."""
+    if isinstance(arguments, dict):
+        if set(arguments) == {"input"} and isinstance(arguments["input"], dict):
+            arguments = arguments["input"]
+        return f"{tool_name} " + "; ".join(f"{k}: {v}" for k, v in sorted(arguments.items()))
+    return f"{tool_name} {arguments}"
+
+
+def key_terms(signature: str) -> Set[str]:
+    """
+    Numbers, ids and proper nouns in a call signature (tokens with a digit, or capitalized
+    mid-sentence), lowercased. Reworded calls only count as the same call if these agree,
+    since "INVG67564" and "INVG67565" or "Delhi" and "Mumbai" embed almost identically.
+    """
+    terms, sentence_start = set(), True
+    for token in re.findall(r"\w+|[.?!:;]", signature):
+        if token in ".?!:;":
+            sentence_start = True
+            continue
+        if any(c.isdigit() for c in token) or (token[0].isupper() and not sentence_start):
+            terms.add(token.lower())
+        sentence_start = False
+    return terms
+
+
+def split_text(text: str, max_chars: int, overlap: int = 0) -> List[str]:
+    """
+    Pieces of at most `max_chars`, cut at the last paragraph, line, sentence or word
+    break in each window; consecutive pieces share about `overlap` characters.
+    """
+    if len(text) <= max_chars:
+        return [text]
+    pieces, start = [], 0
+    while start < len(text):
+        end = min(start + max_chars, len(text))
+        if end < len(text):
+            window = text[start:end]
+            for separator in ("\n\n", "\n", ". ", " "):
+                cut = window.rfind(separator, max_chars // 2)
+                if cut != -1:
+                    end = start + cut + len(separator)
+                    break
+        pieces.append(text[start:end].strip())
+        if end >= len(text):
+            break
+        # Step back by the overlap, then forward to the next word
+        space = text.find(" ", max(end - overlap, start + 1), end)
+        start = space + 1 if space != -1 else end
+    return [piece for piece in pieces if piece]
+
+
+class MemoryRecord:
+    """
+    Stored form of a MemoryItem: a slotted object whose repeated strings (type, tool,
+    session, tags, user query) are interned and shared between records, plus the
+    access stats used for eviction. See benchmarks/memory_footprint.py.
+    """
+    __slots__ = (
+        "id", "text", "type", "timestamp", "tool_name", "user_query", "tags", "session_id",
+        "parent_id", "chunk_index", "chunks", "call_key", "hits", "last_used"
+    )
+
+    def __init__(
+        self,
+        id: int,
+        text: str,
+        type: str = "fact",
+        timestamp: Optional[str] = None,
+        tool_name: Optional[str] = None,
+        user_query: Optional[str] = None,
+        tags: Iterable[str] = (),
+        session_id: Optional[str] = None,
+        parent_id: Optional[int] = None,
+        chunk_index: Optional[int] = None,
+        chunks: Optional[int] = None,
+        call_key: Optional[str] = None
+    ):
+        self.id = id
+        self.text = text
+        self.type = sys.intern(type)
+        self.timestamp = timestamp
+        self.tool_name = _intern(tool_name)
+        self.user_query = _intern(user_query)
+        self.tags = tuple(sys.intern(tag) for tag in tags)
+        self.session_id = _intern(session_id)
+        self.parent_id = parent_id
+        self.chunk_index = chunk_index
+        self.chunks = chunks
+        self.call_key = call_key
+        self.hits = 0
+        self.last_used = created_at(timestamp)
+
+    @classmethod
+    def from_dict(cls, record: dict) -> "MemoryRecord":
+        """From an items.jsonl line; the log only holds validated MemoryItems, so pydantic is skipped."""
+        return cls(
+            id=record.get("id"),
+            text=record["text"],
+            type=record.get("type", "fact"),
+            timestamp=record.get("timestamp"),
+            tool_name=record.get("tool_name"),
+            user_query=record.get("user_query"),
+            tags=record.get("tags") or (),
+            session_id=record.get("session_id"),
+            parent_id=record.get("parent_id"),
+            chunk_index=record.get("chunk_index"),
+            chunks=record.get("chunks"),
+            call_key=record.get("call_key")
+        )
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id, "text": self.text, "type": self.type, "timestamp": self.timestamp,
+            "tool_name": self.tool_name, "user_query": self.user_query,
+            "tags": list(self.tags), "session_id": self.session_id,
+            "parent_id": self.parent_id, "chunk_index": self.chunk_index, "chunks": self.chunks,
+            "call_key": self.call_key
+        }
+
+    def to_item(self, score: Optional[float] = None) -> MemoryItem:
+        return MemoryItem(**self.to_dict(), score=score)
 
 
 class MemoryManager:
-    def __init__(self, embedding_model_url: str, model_name: str = "nomic-embed-text"):
+    def __init__(
+        self,
+        embedding_model_url: str,
+        model_name: str = "nomic-embed-text",
+        batch_url: Optional[str] = None,
+        batch_size: int = 32,
+        cache: Optional[EmbeddingCache] = None,
+        store_dir: Optional[Path] = None,
+        subset_exact_limit: int = 4096,
+        index_config: Optional[dict] = None,
+        compaction: Optional[dict] = None,
+        min_score: Optional[float] = None,
+        chunking: Optional[dict] = None
+    ):
         self.embedding_model_url = embedding_model_url
         self.model_name = model_name
-        self.index: Optional[faiss.IndexFlatL2] = None
-        self.data: List[MemoryItem] = []
-        self.embeddings: List[np.ndarray] = []
+        # Ollama's batch endpoint (/api/embed) takes a list of inputs per request
+        self.batch_url = batch_url or embedding_model_url.replace("/api/embeddings", "/api/embed")
+        self.batch_size = batch_size
+        self.cache = cache or EmbeddingCache(f"{model_name}:embed")
+        # metric / hnsw_threshold / ivf_threshold / quantize / background, see AdaptiveIndex
+        self.index_config = {"metric": "cosine", **(index_config or {}), "subset_exact_limit": subset_exact_limit}
+        # Retrieved items less similar than this are dropped (cosine metric only)
+        self.min_score = min_score
+        self.index: Optional[AdaptiveIndex] = None  # the only copy of the vectors
+        self.data: Dict[int, MemoryRecord] = {}      # embedded items and chunks
+        self.parents: Dict[int, MemoryRecord] = {}   # full texts of chunked items, not embedded
+        self.children: Dict[int, Set[int]] = {}      # parent id → chunk ids
+        self.tool_calls: Dict[str, Set[int]] = {}    # tool name → ids of whole stored results (item or parent)
+        self.next_id = 0
+        self.chunking = {**CHUNKING_DEFAULTS, **(chunking or {})}
+
+        # 🔎 Filter partitions: vector id sets per type / tag / session
+        self.by_type: Dict[str, Set[int]] = {}
+        self.by_tag: Dict[str, Set[int]] = {}
+        self.by_session: Dict[str, Set[int]] = {}
+
+        # 🧹 Compaction policy (access stats for LRU / LFU live on the records)
+        self.compaction = {**COMPACTION_DEFAULTS, **(compaction or {})}
+        self._adds_since_compaction = 0
+
+        # 💾 Persistence: index.faiss + items.jsonl + access.json under store_dir
+        self.store_dir = Path(store_dir) if store_dir else None
+        self._dirty = False
+        self._access_dirty = False
+        if self.store_dir:
+            self.store_dir.mkdir(parents=True, exist_ok=True)
+            self.index_path = self.store_dir / "index.faiss"
+            self.items_path = self.store_dir / "items.jsonl"
+            self.access_path = self.store_dir / "access.json"
+            self.load()
+
+    def load(self):
+        """
+        Replays the items log and maps the saved index into memory, then reconciles
+        the two: vectors of deleted items are dropped, and items appended after the
+        last index save (e.g. the process died before flush) are re-embedded, which
+        the embedding cache makes cheap.
+        """
+        if self.items_path.exists():
+            with open(self.items_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    record = json.loads(line)
+                    if "deleted" in record:
+                        for item_id in record["deleted"]:
+                            self._forget(item_id)
+                        continue
+                    record = MemoryRecord.from_dict(record)
+                    if record.id is None:
+                        record.id = self.next_id  # logs written before items had ids
+                    self._register(record)
+
+        if self.access_path.exists():
+            for item_id, (hits, last_used) in json.loads(self.access_path.read_text()).items():
+                record = self.data.get(int(item_id))
+                if record is not None:
+                    record.hits, record.last_used = hits, last_used
+
+        indexed = np.zeros(0, dtype=np.int64)
+        if self.index_path.exists():
+            self.index = AdaptiveIndex.load(self.index_path, **self.index_config)
+            self._dirty = self.index.migrated
+            indexed = self.index.ids()
+            stale = indexed[~np.isin(indexed, np.fromiter(self.data, dtype=np.int64, count=len(self.data)))]
+            if len(stale):
+                self.index.remove(stale)
+                self._dirty = True
+
+        indexed_ids = set(indexed.tolist())
+        missing = [record for item_id, record in self.data.items() if item_id not in indexed_ids]
+        if missing:
+            embeddings = self._get_embeddings([record.text for record in missing])
+            if self.index is None:
+                self.index = AdaptiveIndex(**self.index_config)
+            self.index.add(embeddings, np.array([record.id for record in missing], dtype=np.int64))
+            self._dirty = True
+
+        self.compact()
+        self.flush()
+        print(f"[memory] Loaded {len(self.data)} memories from {self.store_dir} ({self.index.kind if self.index else 'empty'} index)")
+
+    def flush(self):
+        """Saves the index and access stats next to the items log (write to temp, then atomic rename)."""
+        if not self.store_dir:
+            return
+        if self._dirty and self.index is not None:
+            self.index.save(self.index_path)
+            self._dirty = False
+        if self._access_dirty:
+            tmp_path = self.access_path.with_suffix(".json.tmp")
+            tmp_path.write_text(json.dumps({
+                item_id: [record.hits, record.last_used] for item_id, record in self.data.items()
+            }))
+            os.replace(tmp_path, self.access_path)
+            self._access_dirty = False
+
+    def index_stats(self) -> dict:
+        """Current index type with its search latency and recall figures."""
+        return self.index.stats() if self.index is not None else {"type": None, "ntotal": 0}
 
     def _get_embedding(self, text: str) -> np.ndarray:
-        response = requests.post(
-            self.embedding_model_url,
-            json={"model": self.model_name, "prompt": text}
-        )
-        response.raise_for_status()
-        return np.array(response.json()["embedding"], dtype=np.float32)
+        # Same endpoint as stored items: /api/embed and /api/embeddings vectors differ in scale
+        return self._get_embeddings([text])[0]
+
+    def _get_embeddings(self, texts: List[str], batch_size: Optional[int] = None) -> np.ndarray:
+        """Cached embeddings for `texts` → (len(texts), dim) float32; misses are fetched in batches."""
+        return self.cache.embed(texts, lambda missing: self._request_embeddings(missing, batch_size))
+
+    def _request_embeddings(self, texts: List[str], batch_size: Optional[int] = None) -> np.ndarray:
+        """Embeds `texts` with one /api/embed request per batch."""
+        batch_size = batch_size or self.batch_size
+        vectors = []
+        for start in range(0, len(texts), batch_size):
+            response = requests.post(
+                self.batch_url,
+                json={
+                    "model": self.model_name,
+                    "input": texts[start:start + batch_size],
+                    "keep_alive": ollama_warmup.keep_alive
+                }
+            )
+            response.raise_for_status()
+            data = response.json()
+            ollama_warmup.record(self.model_name, data)
+            vectors.extend(data["embeddings"])
+        return np.array(vectors, dtype=np.float32)
 
     def add(self, item: MemoryItem):
-        embedding = self._get_embedding(item.text)
-        self.embeddings.append(embedding)
-        self.data.append(item)
+        self.bulk_add([item])
 
-        # Init or add to index
-        if self.index is None:
-            self.index = faiss.IndexFlatL2(len(embedding))
-        self.index.add(np.stack([embedding]))
+    def _register(self, record: MemoryRecord):
+        self.next_id = max(self.next_id, record.id + 1)
+        if record.call_key and record.parent_id is None:
+            self.tool_calls.setdefault(record.tool_name, set()).add(record.id)
+        if record.chunks is not None:
+            self.parents[record.id] = record
+            return
+        if record.parent_id is not None:
+            self.children.setdefault(record.parent_id, set()).add(record.id)
+        self.data[record.id] = record
+        self.by_type.setdefault(record.type, set()).add(record.id)
+        for tag in record.tags:
+            self.by_tag.setdefault(tag, set()).add(record.id)
+        if record.session_id:
+            self.by_session.setdefault(record.session_id, set()).add(record.id)
+
+    def _forget(self, item_id: int):
+        if item_id in self.parents:
+            for chunk_id in list(self.children.get(item_id, ())):
+                self._forget(chunk_id)
+            self._drop_parent(item_id)
+            return
+        record = self.data.pop(item_id, None)
+        if record is None:
+            return
+        if record.parent_id is not None:
+            # A parent goes with its last chunk
+            siblings = self.children.get(record.parent_id, set())
+            siblings.discard(item_id)
+            if not siblings:
+                self._drop_parent(record.parent_id)
+        else:
+            self._untrack_call(record)
+        keys = [(self.by_type, record.type), (self.by_session, record.session_id)]
+        keys += [(self.by_tag, tag) for tag in record.tags]
+        for partitions, key in keys:
+            ids = partitions.get(key)
+            if ids is not None:
+                ids.discard(item_id)
+                if not ids:
+                    del partitions[key]
+
+    def _drop_parent(self, parent_id: int):
+        self.children.pop(parent_id, None)
+        parent = self.parents.pop(parent_id, None)
+        if parent is not None:
+            self._untrack_call(parent)
+
+    def _untrack_call(self, record: MemoryRecord):
+        ids = self.tool_calls.get(record.tool_name)
+        if ids is not None:
+            ids.discard(record.id)
+            if not ids:
+                del self.tool_calls[record.tool_name]
+
+    def _matching_ids(
+        self,
+        type_filter: Optional[str],
+        tag_filter: Optional[List[str]],
+        session_filter: Optional[str]
+    ) -> Optional[Set[int]]:
+        """Vector ids passing every filter, or None when no filter is set."""
+        subsets = []
+        if type_filter:
+            subsets.append(self.by_type.get(type_filter, set()))
+        if tag_filter:
+            subsets.append(set().union(*(self.by_tag.get(tag, set()) for tag in tag_filter)))
+        if session_filter:
+            subsets.append(self.by_session.get(session_filter, set()))
+        if not subsets:
+            return None
+        subsets.sort(key=len)
+        return subsets[0].intersection(*subsets[1:])
+
+    def _search(self, query_vec: np.ndarray, top_k: int, ids: Optional[Set[int]]) -> List[Tuple[int, float]]:
+        """(id, score) pairs, best first."""
+        if ids is not None and not ids:
+            return []
+        id_array = np.fromiter(sorted(ids), dtype=np.int64) if ids is not None else None
+        D, I = self.index.search(query_vec, top_k, ids=id_array)
+        return [(int(i), float(d)) for d, i in zip(D[0], I[0]) if i >= 0]
 
     def retrieve(
         self,
@@ -71,33 +475,324 @@ class MemoryManager:
         top_k: int = 3,
         type_filter: Optional[str] = None,
         tag_filter: Optional[List[str]] = None,
-        session_filter: Optional[str] = None
+        session_filter: Optional[str] = None,
+        min_score: Optional[float] = None
     ) -> List[MemoryItem]:
-        if not self.index or len(self.data) == 0:
+        """
+        Nearest items among those matching every filter, each with its similarity
+        `score`. Filters are applied inside the search, so up to `top_k` results come
+        back whenever enough items match; items scoring below `min_score` (default:
+        the configured one) are dropped, so weak matches never reach the prompt.
+        """
+        if self.index is None or len(self.data) == 0:
+            return []
+
+        ids = self._matching_ids(type_filter, tag_filter, session_filter)
+        if ids is not None and not ids:
             return []
 
         query_vec = self._get_embedding(query).reshape(1, -1)
-        D, I = self.index.search(query_vec, top_k * 2)  # overfetch for filtering
+        min_score = min_score if min_score is not None else self.min_score
+        found = [
+            (i, score) for i, score in self._search(query_vec, top_k, ids)
+            if i in self.data and (min_score is None or self.index.metric != "cosine" or score >= min_score)
+        ]
+
+        # 📈 Access stats for LRU / LFU eviction
+        now = time.time()
+        for item_id, _ in found:
+            self.data[item_id].hits += 1
+            self.data[item_id].last_used = now
+        self._access_dirty = self._access_dirty or bool(found)
+        return [self.data[i].to_item(round(score, 4)) for i, score in found]
+
+    def find_tool_result(
+        self,
+        tool_name: str,
+        arguments,
+        max_age_seconds: Optional[float] = None,
+        semantic_threshold: Optional[float] = None
+    ) -> Optional[Tuple[str, str, str]]:
+        """
+        The stored result of an earlier identical call (same call_key) or, when
+        `semantic_threshold` is set, of a call to the same tool with the same key terms
+        (numbers, ids, proper nouns) whose signature embeds at least that close to this
+        one. Only results younger than `max_age_seconds` count; the newest match wins.
+        Returns (result text, "exact" | "semantic", call_key of the matched call).
+        """
+        now = time.time()
+        candidates = [
+            self.parents.get(i) or self.data[i] for i in self.tool_calls.get(tool_name, ())
+        ]
+        candidates = [
+            record for record in candidates
+            if max_age_seconds is None or now - created_at(record.timestamp) <= max_age_seconds
+        ]
+        if not candidates:
+            return None
+        candidates.sort(key=lambda record: record.id, reverse=True)
+
+        def result(record: MemoryRecord, match: str) -> Tuple[str, str, str]:
+            record.hits += 1
+            record.last_used = now
+            self._access_dirty = True
+            arrow = record.text.find(" → ")
+            return (record.text[arrow + 3:] if arrow != -1 else record.text), match, record.call_key
+
+        key = call_key(tool_name, arguments)
+        exact = next((record for record in candidates if record.call_key == key), None)
+        if exact is not None:
+            return result(exact, "exact")
+        if semantic_threshold is None:
+            return None
 
-        results = []
-        for idx in I[0]:
-            if idx >= len(self.data):
-                continue
-            item = self.data[idx]
+        # Only calls naming the same numbers, ids and proper nouns are worth comparing
+        signature = call_signature(tool_name, arguments)
+        terms = key_terms(signature)
+        signatures = [call_signature(tool_name, json.loads(record.call_key[len(tool_name) + 1:])) for record in candidates]
+        same_terms = [i for i, other in enumerate(signatures) if key_terms(other) == terms]
+        if not same_terms:
+            return None
+        candidates = [candidates[i] for i in same_terms]
+        signatures = [signatures[i] for i in same_terms]
 
-            if type_filter and item.type != type_filter:
-                continue
-            if tag_filter and not any(tag in item.tags for tag in tag_filter):
-                continue
-            if session_filter and item.session_id != session_filter:
-                continue
+        # Signatures go through the embedding cache, so earlier calls are embedded only once
+        vectors = self._get_embeddings([signature] + signatures)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        scores = vectors[1:] @ vectors[0]
+        best = int(np.argmax(scores))
+        if scores[best] >= semantic_threshold:
+            return result(candidates[best], "semantic")
+        return None
 
-            results.append(item)
-            if len(results) >= top_k:
-                break
+    def get_parent(self, item: MemoryItem) -> Optional[MemoryItem]:
+        """The full item a retrieved chunk was split from."""
+        parent = self.parents.get(item.parent_id) if item.parent_id is not None else None
+        return parent.to_item() if parent else None
 
-        return results
+    def _chunk(self, item: MemoryItem) -> List[MemoryItem]:
+        """
+        Splits an oversized item into chunks linked to it (the item becomes their parent,
+        with an id but no vector). Each chunk repeats the `tool(args) →` header, so it
+        still says where it came from.
+        """
+        max_chars = self.chunking["max_chars"]
+        if not max_chars or len(item.text) <= max_chars:
+            return [item]
 
-    def bulk_add(self, items: List[MemoryItem]):
+        arrow = item.text.find(" → ", 0, 300)
+        header, body = (item.text[:arrow + 3], item.text[arrow + 3:]) if arrow != -1 else ("", item.text)
+        pieces = split_text(body, max(200, max_chars - len(header) - 16), self.chunking["overlap_chars"])
+
+        item.id = self.next_id
+        item.chunks = len(pieces)
+        self.next_id += 1
+        return [
+            item.model_copy(update={
+                "id": None, "text": f"{header}[part {i + 1}/{len(pieces)}] {piece}",
+                "parent_id": item.id, "chunk_index": i, "chunks": None, "call_key": None
+            })
+            for i, piece in enumerate(pieces)
+        ]
+
+    def bulk_add(self, items: List[MemoryItem], batch_size: Optional[int] = None):
+        """
+        Embeds all items (large ones as chunks) in batched requests and adds them to
+        the index in one call.
+        """
+        if not items:
+            return
+
+        parents = []
+        expanded = []
         for item in items:
-            self.add(item)
+            chunks = self._chunk(item)
+            if chunks[0] is not item:
+                parents.append(item)
+            expanded.extend(chunks)
+        items = expanded
+
+        embeddings = self._get_embeddings([item.text for item in items], batch_size)
+        ids = np.arange(self.next_id, self.next_id + len(items), dtype=np.int64)
+        for item, item_id in zip(items, ids):
+            item.id = int(item_id)
+
+        # Checked before registering, so only older memories count as duplicates
+        superseded = self._near_duplicates(items, embeddings)
+
+        for item in parents + items:
+            self._register(MemoryRecord(**item.model_dump(exclude={"score"})))
+
+        # Init or add to index; vector ids are item ids
+        if self.index is None:
+            self.index = AdaptiveIndex(**self.index_config)
+        self.index.add(embeddings, ids)
+
+        # Items are appended right away; the index is saved on flush()
+        if self.store_dir:
+            with open(self.items_path, "a", encoding="utf-8") as f:
+                f.write("".join(item.model_dump_json(exclude={"score"}) + "\n" for item in parents + items))
+            self._dirty = True
+
+        if superseded:
+            self._remove(superseded)
+
+        self._adds_since_compaction += len(items)
+        if self._adds_since_compaction >= self.compaction["every"]:
+            self.compact()
+
+    # === Compaction ===
+
+    def _near_duplicates(self, items: List[MemoryItem], embeddings: np.ndarray) -> List[int]:
+        """
+        Ids of memories that a new item of the same type nearly repeats (cosine similarity
+        at or above dedupe_threshold, same tool and same key_terms), e.g. the same page
+        fetched twice. The newer copy wins. Similarity alone isn't enough: outputs that
+        differ only in numbers or ids ("add(5, 3) → 8" vs "add(5, 4) → 9") embed almost
+        identically but are both worth keeping.
+        """
+        threshold = self.compaction["dedupe_threshold"]
+        if threshold is None:
+            return []
+
+        terms = [key_terms(item.text) for item in items]
+
+        def repeats(position: int, older) -> bool:
+            return older.tool_name == items[position].tool_name and key_terms(older.text) == terms[position]
+
+        normalized = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+        superseded = set()
+
+        # Within the batch: a later item replaces an earlier one
+        similarity = normalized @ normalized.T
+        for later in range(len(items)):
+            for earlier in range(later):
+                if items[earlier].parent_id is not None and items[earlier].parent_id == items[later].parent_id:
+                    continue  # overlapping chunks of one output
+                if items[earlier].type == items[later].type and similarity[earlier, later] >= threshold \
+                        and repeats(later, items[earlier]):
+                    superseded.add(items[earlier].id)
+
+        # Against stored memories: nearest neighbour of the same type
+        if self.index is not None:
+            by_type: Dict[str, List[int]] = {}
+            for position, item in enumerate(items):
+                by_type.setdefault(item.type, []).append(position)
+            for item_type, positions in by_type.items():
+                candidates = self.by_type.get(item_type)
+                if not candidates:
+                    continue
+                _, I = self.index.search(embeddings[positions], 1, ids=np.fromiter(sorted(candidates), dtype=np.int64))
+                nearest = I[:, 0]
+                valid = nearest >= 0
+                if not valid.any():
+                    continue
+                stored = self.index.reconstruct_batch(nearest[valid])
+                stored /= np.maximum(np.linalg.norm(stored, axis=1, keepdims=True), 1e-12)
+                scores = (normalized[positions][valid] * stored).sum(axis=1)
+                newer = np.asarray(positions)[valid]
+                superseded.update(
+                    int(i) for position, i, score in zip(newer, nearest[valid], scores)
+                    if score >= threshold and repeats(position, self.data[int(i)])
+                )
+
+        return sorted(superseded)
+
+    def _eviction_order(self, ids: Iterable[int]) -> List[int]:
+        """Eviction candidates, first to go first; protected types are left out."""
+        protected = set(self.compaction["protected_types"] or [])
+        candidates = [self.data[i] for i in ids if self.data[i].type not in protected]
+        if self.compaction["eviction"] == "lfu":
+            candidates.sort(key=lambda record: (record.hits, record.last_used))
+        else:
+            candidates.sort(key=lambda record: record.last_used)
+        return [record.id for record in candidates]
+
+    def compact(self) -> Dict[str, int]:
+        """
+        Expires items past their type's TTL, then evicts down to the per-session
+        and global caps. Removed items leave the index and the items log.
+        """
+        self._adds_since_compaction = 0
+        doomed: Dict[int, str] = {}
+
+        # ⏳ TTL per type
+        now = datetime.now()
+        for item_type, days in (self.compaction["ttl_days"] or {}).items():
+            cutoff = (now - timedelta(days=days)).timestamp()
+            for item_id in self.by_type.get(item_type, ()):
+                if created_at(self.data[item_id].timestamp) < cutoff:
+                    doomed[item_id] = "expired"
+
+        # 📦 Per-session cap
+        session_cap = self.compaction["max_items_per_session"]
+        if session_cap:
+            for ids in self.by_session.values():
+                live = [i for i in ids if i not in doomed]
+                for item_id in self._eviction_order(live)[:max(0, len(live) - session_cap)]:
+                    doomed[item_id] = "evicted"
+
+        # 📦 Global cap
+        global_cap = self.compaction["max_items"]
+        if global_cap:
+            live = [i for i in self.data if i not in doomed]
+            for item_id in self._eviction_order(live)[:max(0, len(live) - global_cap)]:
+                doomed[item_id] = "evicted"
+
+        summary = {
+            "expired": sum(reason == "expired" for reason in doomed.values()),
+            "evicted": sum(reason == "evicted" for reason in doomed.values()),
+        }
+        if doomed:
+            self._remove(list(doomed), rewrite=True)
+            print(f"[memory] Compacted: {summary['expired']} expired, {summary['evicted']} evicted, {len(self.data)} left")
+        summary["remaining"] = len(self.data)
+        return summary
+
+    def _remove(self, ids: List[int], rewrite: bool = False):
+        """
+        Drops items from the partitions and the index. The log gets a deletion record,
+        or is rewritten without the removed items when `rewrite` is set.
+        """
+        for item_id in ids:
+            self._forget(item_id)
+        if self.index is not None:
+            self.index.remove(np.array(ids, dtype=np.int64))
+
+        if self.store_dir:
+            if rewrite:
+                tmp_path = self.items_path.with_suffix(".jsonl.tmp")
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    records = {**self.parents, **self.data}
+                    f.write("".join(json.dumps(records[i].to_dict()) + "\n" for i in sorted(records)))
+                os.replace(tmp_path, self.items_path)
+            else:
+                with open(self.items_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps({"deleted": ids}) + "\n")
+            self._dirty = True
+            self._access_dirty = True
+
+
+# One MemoryManager per store, shared by every AgentLoop in the process
+_shared_memories: Dict[str, MemoryManager] = {}
+
+
+def get_shared_memory(memory_config: dict) -> MemoryManager:
+    store_dir = memory_config.get("store_dir")
+    if store_dir and not Path(store_dir).is_absolute():
+        store_dir = Path(__file__).parent.parent / store_dir
+    key = str(store_dir)
+
+    if key not in _shared_memories:
+        _shared_memories[key] = MemoryManager(
+            embedding_model_url=memory_config["embedding_url"],
+            model_name=memory_config["embedding_model"],
+            batch_url=memory_config.get("embedding_batch_url"),
+            batch_size=memory_config.get("embedding_batch_size", 32),
+            store_dir=store_dir,
+            index_config=memory_config.get("index"),
+            compaction=memory_config.get("compaction"),
+            min_score=memory_config.get("min_score"),
+            chunking=memory_config.get("chunking")
+        )
+    return _shared_memories[key]
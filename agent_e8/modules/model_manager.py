@@ -1,10 +1,16 @@
 import os
 import json
+import time
 import yaml
+import asyncio
 import requests
+from collections import deque
 from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple, Type
+from pydantic import BaseModel
 from google import genai
 from dotenv import load_dotenv
+from modules.warmup import ollama_warmup
 
 load_dotenv()
 
@@ -12,7 +18,67 @@ ROOT = Path(__file__).parent.parent
 MODELS_JSON = ROOT / "config" / "models.json"
 PROFILE_YAML = ROOT / "config" / "profiles.yaml"
 
+
+class ChatSession:
+    """
+    Running conversation for one agent session.
+    Turns alternate user → model, starting with the full task prompt.
+    """
+
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        self.turns: List[Dict[str, str]] = []
+        self.compactions = 0
+
+    def add(self, role: str, text: str):
+        self.turns.append({"role": role, "text": text})
+
+    def size(self) -> int:
+        return sum(len(turn["text"]) for turn in self.turns)
+
+
+class ModelStats:
+    """Rolling latency / error window for one model."""
+
+    def __init__(self, window: int = 50):
+        self.latencies = deque(maxlen=window)
+        self.outcomes = deque(maxlen=window)
+
+    def record(self, latency: float, ok: bool):
+        self.outcomes.append(ok)
+        if ok:
+            self.latencies.append(latency)
+
+    def percentile(self, p: float) -> float:
+        ordered = sorted(self.latencies)
+        rank = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+        return ordered[rank]
+
+    def error_rate(self) -> float:
+        if not self.outcomes:
+            return 0.0
+        return 1 - sum(self.outcomes) / len(self.outcomes)
+
+    def summary(self) -> Dict[str, float]:
+        return {
+            "samples": len(self.outcomes),
+            "p50": round(self.percentile(50), 3) if self.latencies else None,
+            "p90": round(self.percentile(90), 3) if self.latencies else None,
+            "error_rate": round(self.error_rate(), 3),
+        }
+
+
+# (reply text, input tokens, output tokens) as reported by the provider
+Completion = Tuple[str, Optional[int], Optional[int]]
+
+
 class ModelManager:
+    # Shared by every ModelManager in the process (perception, decision, ...)
+    stats: Dict[str, ModelStats] = {}
+    usage: Dict[str, Dict[str, int]] = {}
+    measured_chars = 0
+    measured_tokens = 0
+
     def __init__(self):
         self.config = json.loads(MODELS_JSON.read_text())
         self.profile = yaml.safe_load(PROFILE_YAML.read_text())
@@ -21,26 +87,350 @@ class ModelManager:
         self.model_info = self.config["models"][self.text_model_key]
         self.model_type = self.model_info["type"]
 
+        # 💬 Conversation mode settings
+        conversation = self.profile["llm"].get("conversation", {})
+        self.chat_max_chars = conversation.get("max_history_chars", 24000)
+        self.chat_keep_recent = conversation.get("keep_recent_turns", 2)
+        self.chats: Dict[str, ChatSession] = {}
+
+        # ⏱️ Hedging / failover settings
+        hedging = self.profile["llm"].get("hedging", {})
+        self.hedging_enabled = hedging.get("enabled", False)
+        self.backup_keys = hedging.get("backups", [])
+        self.hedge_percentile = hedging.get("latency_percentile", 90)
+        self.hedge_min_delay = hedging.get("min_delay", 2.0)
+        self.hedge_min_samples = hedging.get("min_samples", 5)
+        self.max_error_rate = hedging.get("max_error_rate", 0.5)
+        # Only bounds requests while hedging is on; without backups a slow model is simply waited for
+        self.request_timeout = hedging.get("timeout", 60) if self.hedging_enabled else None
+        self.stats_window = hedging.get("window", 50)
+
+        # 🧮 Prompt budgets (tokens per stage)
+        self.prompt_budgets = dict(self.profile["llm"].get("prompt_budget", {}))
+        self.default_chars_per_token = self.prompt_budgets.pop("chars_per_token", 4)
+
         # ✅ Gemini initialization (your style)
-        if self.model_type == "gemini":
+        self.client = None
+        model_types = {self.config["models"][key]["type"] for key in [self.text_model_key] + self.backup_keys}
+        if "gemini" in model_types:
             api_key = os.getenv("GOOGLE_API_KEY")
             self.client = genai.Client(api_key=api_key)
 
-    async def generate_text(self, prompt: str) -> str:
-        if self.model_type == "gemini":
-            return self._gemini_generate(prompt)
+    async def generate_text(self, prompt: str, stage: str = "default") -> str:
+        model_key, (text, input_tokens, output_tokens) = await self._hedged(
+            lambda key: self._generate_with(key, prompt)
+        )
+        self.record_usage(stage, model_key, len(prompt), input_tokens, output_tokens, text)
+        return text
+
+    async def generate_json(self, prompt: str, schema: Type[BaseModel], stage: str = "default") -> BaseModel:
+        """
+        Schema-constrained generation: Gemini gets `response_schema`, Ollama gets `format`.
+        The reply is validated against `schema`; a reply that doesn't validate counts
+        as a failed call, so hedging moves on to the next model.
+        """
+        def call(key: str) -> Completion:
+            completion = self._generate_with(key, prompt, schema)
+            schema.model_validate_json(completion[0])
+            return completion
+
+        model_key, (text, input_tokens, output_tokens) = await self._hedged(call)
+        self.record_usage(stage, model_key, len(prompt), input_tokens, output_tokens, text)
+        return schema.model_validate_json(text)
+
+    def _generate_with(self, model_key: str, prompt: str, schema: Optional[Type[BaseModel]] = None) -> Completion:
+        model_info = self.config["models"][model_key]
+        if model_info["type"] == "gemini":
+            return self._gemini_generate(model_info, prompt, schema)
+
+        elif model_info["type"] == "ollama":
+            return self._ollama_generate(model_info, prompt, schema)
+
+        raise NotImplementedError(f"Unsupported model type: {model_info['type']}")
+
+    # === Hedged requests ===
+
+    def _stats_for(self, model_key: str) -> ModelStats:
+        if model_key not in ModelManager.stats:
+            ModelManager.stats[model_key] = ModelStats(self.stats_window)
+        return ModelManager.stats[model_key]
+
+    def rank_models(self) -> List[str]:
+        """
+        Orders the configured model and its backups for the next request.
+        The configured model leads while healthy; backups follow by median latency,
+        and any model over `max_error_rate` in its window drops to the end.
+        """
+        if not self.hedging_enabled:
+            return [self.text_model_key]
+
+        def median(key: str) -> float:
+            stats = self._stats_for(key)
+            return stats.percentile(50) if stats.latencies else float("inf")
+
+        def healthy(key: str) -> bool:
+            return self._stats_for(key).error_rate() <= self.max_error_rate
+
+        backups = sorted(self.backup_keys, key=median)
+        ordered = [self.text_model_key] + backups
+        return [key for key in ordered if healthy(key)] + [key for key in ordered if not healthy(key)]
+
+    def hedge_delay(self, model_key: str) -> float:
+        stats = self._stats_for(model_key)
+        if len(stats.latencies) < self.hedge_min_samples:
+            return self.hedge_min_delay
+        return max(self.hedge_min_delay, stats.percentile(self.hedge_percentile))
+
+    def model_health(self) -> Dict[str, Dict[str, float]]:
+        return {key: stats.summary() for key, stats in ModelManager.stats.items()}
+
+    async def _timed_call(self, model_key: str, call: Callable[[str], Completion]) -> Completion:
+        start = time.perf_counter()
+        try:
+            result = await asyncio.to_thread(call, model_key)
+        except Exception:
+            self._stats_for(model_key).record(time.perf_counter() - start, ok=False)
+            raise
+        self._stats_for(model_key).record(time.perf_counter() - start, ok=True)
+        return result
+
+    async def _hedged(self, call: Callable[[str], Completion]) -> Tuple[str, Completion]:
+        """
+        Sends `call` to the best-ranked model and returns (model key, completion). If it hasn't answered within its
+        latency percentile, or it fails, the next model is started as well and
+        the first successful answer wins. Slower requests are left to finish in
+        the background so their latency still lands in the rolling window.
+        """
+        candidates = self.rank_models()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.request_timeout if self.request_timeout else float("inf")
+        pending: Dict[asyncio.Task, str] = {}
+        errors = []
+        last_error: Optional[BaseException] = None
+
+        def launch(model_key: str):
+            task = asyncio.create_task(self._timed_call(model_key, call))
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            pending[task] = model_key
+
+        launch(candidates.pop(0))
+        while pending:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            wait = min(remaining, self.hedge_delay(list(pending.values())[-1])) if candidates else remaining
+            if wait == float("inf"):
+                wait = None
+            done, _ = await asyncio.wait(pending, timeout=wait, return_when=asyncio.FIRST_COMPLETED)
 
-        elif self.model_type == "ollama":
-            return self._ollama_generate(prompt)
+            for task in done:
+                model_key = pending.pop(task)
+                if task.exception() is None:
+                    if model_key != self.text_model_key:
+                        print(f"[model] ⏱️ Answer served by backup model {model_key}")
+                    return model_key, task.result()
+                last_error = task.exception()
+                errors.append(f"{model_key}: {last_error}")
 
-        raise NotImplementedError(f"Unsupported model type: {self.model_type}")
+            # Timed out waiting, or every in-flight request failed → bring in the next model
+            if candidates and (not done or not pending):
+                launch(candidates.pop(0))
 
-    def _gemini_generate(self, prompt: str) -> str:
+        if not pending and last_error is not None:
+            # Every model failed before the deadline → that's the real error, not a timeout
+            raise last_error
+        raise TimeoutError(f"No model answered within {self.request_timeout}s. Errors: {errors or 'none'}")
+
+    # === Token accounting & prompt budgets ===
+
+    def chars_per_token(self) -> float:
+        """Calibrated from provider usage metadata once any call has reported it."""
+        if ModelManager.measured_tokens:
+            return ModelManager.measured_chars / ModelManager.measured_tokens
+        return self.default_chars_per_token
+
+    def count_tokens(self, text: str) -> int:
+        return int(len(text) / self.chars_per_token()) + 1
+
+    def record_usage(
+        self,
+        stage: str,
+        model_key: str,
+        prompt_chars: int,
+        input_tokens: Optional[int],
+        output_tokens: Optional[int],
+        reply: str,
+    ):
+        if input_tokens:
+            ModelManager.measured_chars += prompt_chars
+            ModelManager.measured_tokens += input_tokens
+        else:
+            input_tokens = int(prompt_chars / self.chars_per_token())
+        if output_tokens is None:
+            output_tokens = self.count_tokens(reply)
+
+        totals = ModelManager.usage.setdefault(stage, {"calls": 0, "input_tokens": 0, "output_tokens": 0})
+        totals["calls"] += 1
+        totals["input_tokens"] += input_tokens
+        totals["output_tokens"] += output_tokens
+        print(f"[tokens] {stage} via {model_key}: in={input_tokens} out={output_tokens}")
+
+    @classmethod
+    def usage_report(cls) -> Dict[str, Dict[str, int]]:
+        return {stage: dict(totals) for stage, totals in cls.usage.items()}
+
+    def trim_text(self, text: str, max_tokens: int) -> str:
+        """Keeps the head and tail of `text` around a truncation marker."""
+        max_chars = int(max_tokens * self.chars_per_token())
+        if len(text) <= max_chars:
+            return text
+        marker = f"\n…[{len(text) - max_chars} characters trimmed to fit the prompt budget]…\n"
+        keep = max(0, max_chars - len(marker))
+        head = int(keep * 0.75)
+        tail = keep - head
+        return f"{text[:head]}{marker}{text[len(text) - tail:]}"
+
+    def enforce_budget(self, stage: str, prompt: str, sections: List[str], min_tokens: int = 40) -> str:
+        """
+        Shrinks `prompt` to the stage's token budget (llm.prompt_budget in profiles.yaml).
+        `sections` are substrings of the prompt, lowest value first (e.g. least relevant
+        memory, then oversized tool output). Each is trimmed in turn, down to
+        `min_tokens`, until the prompt fits. Unbudgeted stages pass through unchanged.
+        """
+        budget = self.prompt_budgets.get(stage)
+        if not budget:
+            return prompt
+
+        overflow = self.count_tokens(prompt) - budget
+        for section in sections:
+            if overflow <= 0:
+                break
+            if not section or section not in prompt:
+                continue
+            section_tokens = self.count_tokens(section)
+            target = max(min_tokens, section_tokens - overflow)
+            if target >= section_tokens:
+                continue
+            trimmed = self.trim_text(section, target)
+            prompt = prompt.replace(section, trimmed, 1)
+            overflow = self.count_tokens(prompt) - budget
+
+        if overflow > 0:
+            print(f"[tokens] ⚠️ {stage} prompt is still {overflow} tokens over its budget of {budget}")
+        return prompt
+
+    # === Conversation mode ===
+
+    def has_chat(self, session_id: str) -> bool:
+        return session_id in self.chats
+
+    async def chat(self, session_id: str, message: str, stage: str = "plan") -> str:
+        """
+        Appends `message` to the session's conversation and returns the model reply.
+        Only the new message is built by the caller; earlier turns are replayed
+        from the session history, compacted once it exceeds `max_history_chars`.
+        """
+        return await self._chat(session_id, message, stage)
+
+    async def chat_json(self, session_id: str, message: str, schema: Type[BaseModel], stage: str = "plan") -> BaseModel:
+        """Like `chat()`, with the reply constrained to and validated against `schema`."""
+        return schema.model_validate_json(await self._chat(session_id, message, stage, schema))
+
+    async def _chat(self, session_id: str, message: str, stage: str, schema: Optional[Type[BaseModel]] = None) -> str:
+        session = self.chats.setdefault(session_id, ChatSession(session_id))
+        await self._compact_chat(session)
+        session.add("user", message)
+        turns = list(session.turns)
+
+        def call(key: str) -> Completion:
+            completion = self._chat_with(key, turns, schema)
+            if schema is not None:
+                schema.model_validate_json(completion[0])
+            return completion
+
+        try:
+            model_key, (reply, input_tokens, output_tokens) = await self._hedged(call)
+        except Exception:
+            session.turns.pop()
+            raise
+
+        prompt_chars = sum(len(turn["text"]) for turn in turns)
+        self.record_usage(stage, model_key, prompt_chars, input_tokens, output_tokens, reply)
+        session.add("model", reply)
+        return reply
+
+    def _chat_with(self, model_key: str, turns: List[Dict[str, str]], schema: Optional[Type[BaseModel]] = None) -> Completion:
+        model_info = self.config["models"][model_key]
+        if model_info["type"] == "gemini":
+            return self._gemini_chat(model_info, turns, schema)
+
+        elif model_info["type"] == "ollama":
+            return self._ollama_chat(model_info, turns, schema)
+
+        raise NotImplementedError(f"Unsupported model type: {model_info['type']}")
+
+    def end_chat(self, session_id: str):
+        self.chats.pop(session_id, None)
+
+    async def _compact_chat(self, session: ChatSession):
+        """
+        Summarizes the middle of the conversation when it outgrows the budget.
+        The opening exchange (task prompt + first reply) and the most recent
+        `keep_recent_turns` exchanges are kept verbatim.
+        """
+        if session.size() <= self.chat_max_chars:
+            return
+
+        keep = 2 * self.chat_keep_recent
+        # turns[-0:] would be the whole history, so keep_recent_turns: 0 needs its own empty tail
+        tail = session.turns[len(session.turns) - keep:] if keep else []
+        head, middle = session.turns[:2], session.turns[2:len(session.turns) - keep]
+        if not middle:
+            return
+
+        transcript = "\n\n".join(f"{turn['role'].upper()}: {turn['text']}" for turn in middle)
+        prompt = f"""
+Summarize the following agent steps for the agent's own working memory.
+Keep every tool call made, its key parameters and the facts, numbers, names and links it returned.
+Drop formatting, repetition and anything not needed to finish the task.
+
+{transcript}
+"""
+        summary = await self.generate_text(prompt, stage="compaction")
+        session.turns = head + [
+            {"role": "user", "text": f"Summary of the earlier steps:\n{summary}"},
+            {"role": "model", "text": "Noted."},
+        ] + tail
+        session.compactions += 1
+
+    def _gemini_generate(self, model_info: dict, prompt: str, schema: Optional[Type[BaseModel]] = None) -> Completion:
         response = self.client.models.generate_content(
-            model=self.model_info["model"],
-            contents=prompt
+            model=model_info["model"],
+            contents=prompt,
+            config=self._gemini_config(schema)
         )
+        return (self._gemini_text(response), *self._gemini_usage(response))
 
+    def _gemini_chat(self, model_info: dict, turns: List[Dict[str, str]], schema: Optional[Type[BaseModel]] = None) -> Completion:
+        response = self.client.models.generate_content(
+            model=model_info["model"],
+            contents=[{"role": turn["role"], "parts": [{"text": turn["text"]}]} for turn in turns],
+            config=self._gemini_config(schema)
+        )
+        return (self._gemini_text(response), *self._gemini_usage(response))
+
+    def _gemini_config(self, schema: Optional[Type[BaseModel]]) -> Optional[dict]:
+        if schema is None:
+            return None
+        return {"response_mime_type": "application/json", "response_schema": schema}
+
+    def _gemini_usage(self, response) -> Tuple[Optional[int], Optional[int]]:
+        usage = getattr(response, "usage_metadata", None)
+        if usage is None:
+            return None, None
+        return usage.prompt_token_count, usage.candidates_token_count
+
+    def _gemini_text(self, response) -> str:
         # ✅ Safely extract response text
         try:
             return response.text.strip()
@@ -50,10 +440,44 @@ class ModelManager:
             except Exception:
                 return str(response)
 
-    def _ollama_generate(self, prompt: str) -> str:
+    def _ollama_generate(self, model_info: dict, prompt: str, schema: Optional[Type[BaseModel]] = None) -> Completion:
+        payload = {
+            "model": model_info["model"],
+            "prompt": prompt,
+            "stream": False,
+            "keep_alive": ollama_warmup.keep_alive
+        }
+        if schema is not None:
+            payload["format"] = schema.model_json_schema()
+        response = requests.post(
+            model_info["url"]["generate"],
+            json=payload,
+            timeout=self.request_timeout
+        )
+        response.raise_for_status()
+        data = response.json()
+        ollama_warmup.record(model_info["model"], data)
+        return data["response"].strip(), data.get("prompt_eval_count"), data.get("eval_count")
+
+    def _ollama_chat(self, model_info: dict, turns: List[Dict[str, str]], schema: Optional[Type[BaseModel]] = None) -> Completion:
+        messages = [
+            {"role": "assistant" if turn["role"] == "model" else "user", "content": turn["text"]}
+            for turn in turns
+        ]
+        payload = {
+            "model": model_info["model"],
+            "messages": messages,
+            "stream": False,
+            "keep_alive": ollama_warmup.keep_alive
+        }
+        if schema is not None:
+            payload["format"] = schema.model_json_schema()
         response = requests.post(
-            self.model_info["url"]["generate"],
-            json={"model": self.model_info["model"], "prompt": prompt, "stream": False}
+            model_info["url"]["chat"],
+            json=payload,
+            timeout=self.request_timeout
         )
         response.raise_for_status()
-        return response.json()["response"].strip()
+        data = response.json()
+        ollama_warmup.record(model_info["model"], data)
+        return data["message"]["content"].strip(), data.get("prompt_eval_count"), data.get("eval_count")
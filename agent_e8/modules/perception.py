@@ -2,6 +2,7 @@ from typing import List, Optional
 from pydantic import BaseModel
 import os
 import re
+import ast
 import json
 from dotenv import load_dotenv
 from modules.model_manager import ModelManager
@@ -11,12 +12,20 @@ from config.log_config import setup_logging
 logger = setup_logging(__name__)
 
 model = ModelManager()
+STRUCTURED_OUTPUT = model.profile["llm"].get("structured_output", False)
 tool_context = summarize_tools(model.get_all_tools()) if hasattr(model, "get_all_tools") else ""
 
 
 class PerceptionResult(BaseModel):
     user_input: str
-    intent: Optional[str]
+    intent: Optional[str] = None
+    entities: List[str] = []
+    tool_hint: Optional[str] = None
+
+
+class PerceptionOutput(BaseModel):
+    """Response schema the LLM fills in structured output mode."""
+    intent: str
     entities: List[str] = []
     tool_hint: Optional[str] = None
 
@@ -29,6 +38,20 @@ async def extract_perception(user_input: str) -> PerceptionResult:
     - tool_hint: likely MCP tool name (optional)
     """
 
+    if STRUCTURED_OUTPUT:
+        response_format = """Respond with one JSON object matching the response schema:
+- intent: (brief phrase about what the user wants)
+- entities: a list of strings representing keywords or values (e.g., ["INDIA", "ASCII"])
+- tool_hint: (name of the MCP tool that might be useful, if any)"""
+    else:
+        response_format = """Return the response as a Python dictionary with keys:
+- intent: (brief phrase about what the user wants)
+- entities: a list of strings representing keywords or values (e.g., ["INDIA", "ASCII"])
+- tool_hint: (name of the MCP tool that might be useful, if any)
+- user_input: same as above
+
+Output only the dictionary on a single line. Do NOT wrap it in ```json or other formatting. Ensure `entities` is a list of strings, not a dictionary."""
+
     prompt = f"""
 You are an AI that extracts structured facts from user input.
 
@@ -36,17 +59,22 @@ Available tools: {tool_context}
 
 Input: "{user_input}"
 
-Return the response as a Python dictionary with keys:
-- intent: (brief phrase about what the user wants)
-- entities: a list of strings representing keywords or values (e.g., ["INDIA", "ASCII"])
-- tool_hint: (name of the MCP tool that might be useful, if any)
-- user_input: same as above
-
-Output only the dictionary on a single line. Do NOT wrap it in ```json or other formatting. Ensure `entities` is a list of strings, not a dictionary.
+{response_format}
 """
 
+    prompt = model.enforce_budget("perception", prompt, [user_input])
+
+    if STRUCTURED_OUTPUT:
+        try:
+            output = await model.generate_json(prompt, PerceptionOutput, stage="perception")
+            logger.info(f"Perception response: {output}")
+            return PerceptionResult(user_input=user_input, **output.model_dump())
+        except Exception as e:
+            print(f"[perception] ⚠️ LLM perception failed: {e}")
+            return PerceptionResult(user_input=user_input)
+
     try:
-        response = await model.generate_text(prompt)
+        response = await model.generate_text(prompt, stage="perception")
 
         logger.info(f"Perception response: {response}")
 
@@ -62,16 +90,14 @@ Output only the dictionary on a single line. Do NOT wrap it in ```json or other
         logger.info(f"Perception clean: {clean}")
 
         try:
-            # Replace Python None/True/False with JSON null/true/false
-            json_ready = (
-                clean.replace("None", "null")
-                     .replace("True", "true")
-                     .replace("False", "false")
-            )
-            parsed = json.loads(json_ready)
-        except Exception as json_error:
-            print(f"[perception] JSON parsing failed: {json_error}")
-            parsed = {}
+            parsed = json.loads(clean)
+        except json.JSONDecodeError:
+            try:
+                # Python dict literal (None/True/False) — parsed as-is so entity text stays intact
+                parsed = ast.literal_eval(clean)
+            except Exception as parse_error:
+                print(f"[perception] JSON parsing failed: {parse_error}")
+                parsed = {}
 
         # Ensure Keys
         if not isinstance(parsed, dict):
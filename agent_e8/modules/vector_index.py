@@ -0,0 +1,429 @@
+# modules/vector_index.py → Adaptive Vector Index
+# Role: FAISS index that starts flat and upgrades itself as the corpus grows.
+
+# Responsibilities:
+
+# Exact (flat) search while the corpus is small
+
+# Past configurable sizes, retrain into HNSW or IVF (optionally SQ8-quantized) in a
+# background thread and swap the new index in atomically
+
+# Filtered search (id subsets) and stable caller-assigned vector ids
+
+# Remove vectors (HNSW can't, so removed ids are tombstoned until the next rebuild)
+
+# Cosine metric: vectors normalized on the way in, inner-product indexes, similarity
+# scores returned (existing L2 indexes are migrated on load)
+
+# Expose the current index type plus recall / latency statistics
+
+# Dependencies:
+
+# faiss, numpy
+
+# Used by: memory.py (agent memory), mcp_server_2.py (document index)
+
+# modules/vector_index.py
+
+from typing import Callable, Dict, List, Optional, Set, Tuple
+from collections import deque
+from pathlib import Path
+import json
+import math
+import os
+import threading
+import time
+import numpy as np
+import faiss
+
+# Upgrade order; an index is only ever rebuilt into a later kind
+KINDS = ["flat", "hnsw", "ivf"]
+METRICS = {"l2": faiss.METRIC_L2, "cosine": faiss.METRIC_INNER_PRODUCT}
+
+
+def stored_ids(index) -> np.ndarray:
+    """Vector ids held by an IDMap2-wrapped or IVF index."""
+    if isinstance(index, faiss.IndexIDMap2):
+        return faiss.vector_to_array(index.id_map).astype(np.int64)
+    ivf = faiss.extract_index_ivf(index)
+    invlists = ivf.invlists
+    lists = [
+        faiss.rev_swig_ptr(invlists.get_ids(l), invlists.list_size(l)).copy()
+        for l in range(ivf.nlist) if invlists.list_size(l)
+    ]
+    return np.concatenate(lists).astype(np.int64) if lists else np.zeros(0, dtype=np.int64)
+
+
+def index_kind(index) -> str:
+    if isinstance(index, faiss.IndexIDMap2):
+        inner = faiss.downcast_index(index.index)
+        if isinstance(inner, faiss.IndexHNSWSQ):
+            return "hnsw_sq8"
+        if isinstance(inner, faiss.IndexHNSW):
+            return "hnsw"
+        return "flat"
+    return "ivf_sq8" if isinstance(index, faiss.IndexIVFScalarQuantizer) else "ivf"
+
+
+class AdaptiveIndex:
+    """
+    Wraps one FAISS index addressed by caller-assigned int64 ids.
+    Flat and HNSW indexes are wrapped in IndexIDMap2; IVF keeps ids natively
+    (with a hashtable direct map so vectors can still be reconstructed).
+
+    metric "l2" returns squared distances (lower is closer); "cosine" returns
+    similarities in [-1, 1] (higher is closer).
+    """
+
+    def __init__(
+        self,
+        dim: Optional[int] = None,
+        metric: str = "l2",
+        hnsw_threshold: Optional[int] = 20000,
+        ivf_threshold: Optional[int] = 200000,
+        quantize: bool = False,
+        background: bool = True,
+        subset_exact_limit: int = 4096,
+        hnsw_m: int = 32,
+        ef_search: int = 64,
+        nprobe: int = 16,
+        recall_sample: int = 100,
+        tombstone_ratio: float = 0.2,
+        latency_window: int = 200,
+        log: Callable[[str], None] = print
+    ):
+        self.dim = dim
+        self.metric = metric
+        self.faiss_metric = METRICS[metric]
+        self.hnsw_threshold = hnsw_threshold  # None disables the upgrade
+        self.ivf_threshold = ivf_threshold
+        self.quantize = quantize              # SQ8: ~4x smaller vectors, slightly lower recall
+        self.background = background          # False rebuilds inline (batch indexing scripts)
+        self.subset_exact_limit = subset_exact_limit
+        self.hnsw_m = hnsw_m
+        self.ef_search = ef_search
+        self.nprobe = nprobe
+        self.recall_sample = recall_sample
+        self.tombstone_ratio = tombstone_ratio  # rebuild once this share of vectors is tombstoned
+        self.log = log
+
+        self.index = None
+        self._lock = threading.RLock()
+        self._rebuild_thread: Optional[threading.Thread] = None
+        self._pending: Optional[List[Tuple[np.ndarray, np.ndarray]]] = None  # adds made during a rebuild
+        self._pending_removals: List[np.ndarray] = []                        # removes made during a rebuild
+        self.tombstones: Set[int] = set()
+
+        # 📊 Stats
+        self.latencies = deque(maxlen=latency_window)
+        self.searches = 0
+        self.exact_fallbacks = 0
+        self.upgrades: List[Dict] = []
+        self.migrated = False  # set by load() when the saved index had another metric
+
+    # === Construction / persistence ===
+
+    @classmethod
+    def load(cls, path: Path, **kwargs) -> "AdaptiveIndex":
+        """
+        Reads a saved index. An index saved with another metric is rebuilt in place and
+        `migrated` is set, so the caller knows to save it.
+        """
+        adaptive = cls(**kwargs)
+        # A plain read, not IO_FLAG_MMAP: mmap'd IVF lists are read-only (add/remove would
+        # fail), and flat/HNSW indexes are copied into memory either way
+        index = faiss.read_index(str(path))
+
+        if not isinstance(index, faiss.IndexIDMap2) and faiss.try_extract_index_ivf(index) is None:
+            # Legacy flat index without ids: vector i keeps id i
+            vectors = index.reconstruct_n(0, index.ntotal)
+            index = faiss.IndexIDMap2(faiss.IndexFlat(index.d, index.metric_type))
+            index.add_with_ids(vectors, np.arange(len(vectors), dtype=np.int64))
+
+        adaptive.index = index
+        adaptive.dim = index.d
+        stats_path = Path(path).with_name(Path(path).name + ".json")
+        if stats_path.exists():
+            sidecar = json.loads(stats_path.read_text())
+            adaptive.upgrades = sidecar.get("upgrades", [])
+            adaptive.tombstones = set(sidecar.get("tombstones", []))
+
+        if index.metric_type != adaptive.faiss_metric:
+            adaptive._migrate()
+        return adaptive
+
+    def _migrate(self):
+        """Rebuilds the index (same kind) under this index's metric, e.g. L2 → cosine."""
+        start = time.perf_counter()
+        ids = self.ids()
+        vectors = self._prepare(self.index.reconstruct_batch(ids))
+        old_kind = self.kind
+        self.index = self._build(old_kind.replace("_sq8", ""), vectors, ids)
+        self.tombstones = set()
+        self.migrated = True
+        self.log(f"[index] Migrated {old_kind} index of {len(ids)} vectors to {self.metric} in {time.perf_counter() - start:.1f}s")
+
+    def save(self, path: Path):
+        """
+        Writes to a temp file, then renames, so readers never see a partial index.
+        Upgrade history (with measured recall) and tombstones go to a `<name>.json` sidecar.
+        """
+        path = Path(path)
+        tmp_path = path.with_name(path.name + ".tmp")
+        with self._lock:
+            if self.index is None:
+                return
+            faiss.write_index(self.index, str(tmp_path))
+            sidecar = {"upgrades": self.upgrades, "tombstones": sorted(self.tombstones)}
+        os.replace(tmp_path, path)
+        path.with_name(path.name + ".json").write_text(json.dumps(sidecar, indent=2))
+
+    @property
+    def ntotal(self) -> int:
+        """Live vectors (tombstoned ones excluded)."""
+        return self.index.ntotal - len(self.tombstones) if self.index is not None else 0
+
+    def ids(self) -> np.ndarray:
+        with self._lock:
+            if self.index is None:
+                return np.zeros(0, dtype=np.int64)
+            ids = stored_ids(self.index)
+            return ids[~np.isin(ids, self._tombstone_array())] if self.tombstones else ids
+
+    def _tombstone_array(self) -> np.ndarray:
+        return np.fromiter(self.tombstones, dtype=np.int64, count=len(self.tombstones))
+
+    @property
+    def kind(self) -> Optional[str]:
+        return index_kind(self.index) if self.index is not None else None
+
+    def _prepare(self, vectors: np.ndarray) -> np.ndarray:
+        """float32, contiguous and, for cosine, L2-normalized (always a copy then)."""
+        if self.metric != "cosine":
+            return np.ascontiguousarray(vectors, dtype=np.float32)
+        vectors = np.array(vectors, dtype=np.float32, order="C")
+        faiss.normalize_L2(vectors)
+        return vectors
+
+    def _build(self, kind: str, vectors: np.ndarray, ids: np.ndarray):
+        dim = vectors.shape[1]
+        suffix = ",SQ8" if self.quantize else ""
+        if kind == "flat":
+            index = faiss.IndexIDMap2(faiss.IndexFlat(dim, self.faiss_metric))
+        elif kind == "hnsw":
+            index = faiss.index_factory(dim, f"IDMap2,HNSW{self.hnsw_m}{suffix}", self.faiss_metric)
+            faiss.downcast_index(index.index).hnsw.efSearch = self.ef_search
+        else:
+            nlist = max(1, int(4 * math.sqrt(len(vectors))))
+            index = faiss.index_factory(dim, f"IVF{nlist},Flat" if not self.quantize else f"IVF{nlist},SQ8", self.faiss_metric)
+            index.nprobe = min(self.nprobe, nlist)
+            index.set_direct_map_type(faiss.DirectMap.Hashtable)
+
+        if not index.is_trained:
+            # k-means needs ~40 points per list; more than 256 per list buys nothing
+            sample = vectors
+            if kind == "ivf" and len(vectors) > 256 * index.nlist:
+                sample = vectors[np.random.default_rng(0).choice(len(vectors), 256 * index.nlist, replace=False)]
+            index.train(sample)
+        if len(vectors):
+            index.add_with_ids(vectors, ids)
+        return index
+
+    # === Writes ===
+
+    def add(self, vectors: np.ndarray, ids: np.ndarray):
+        vectors = self._prepare(vectors)
+        ids = np.asarray(ids, dtype=np.int64)
+        with self._lock:
+            if self.index is None:
+                self.dim = vectors.shape[1]
+                self.index = self._build("flat", vectors[:0], ids[:0])
+            self.index.add_with_ids(vectors, ids)
+            if self._pending is not None:
+                self._pending.append((vectors, ids))
+        self.maybe_upgrade()
+
+    def target_kind(self, n: int) -> str:
+        if self.ivf_threshold and n >= self.ivf_threshold:
+            return "ivf"
+        if self.hnsw_threshold and n >= self.hnsw_threshold:
+            return "hnsw"
+        return "flat"
+
+    def remove(self, ids: np.ndarray) -> int:
+        """Removes vectors by id; returns how many were removed (or tombstoned)."""
+        ids = np.asarray(ids, dtype=np.int64)
+        if self.index is None or not len(ids):
+            return 0
+        with self._lock:
+            if self._pending is not None:
+                self._pending_removals.append(ids)
+            removed = self._remove_from(self.index, ids)
+        self.maybe_upgrade()
+        return removed
+
+    def _remove_from(self, index, ids: np.ndarray) -> int:
+        if index_kind(index).startswith("hnsw"):
+            # HNSW graphs can't drop nodes: hide them from searches until the next rebuild
+            before = len(self.tombstones)
+            self.tombstones.update(int(i) for i in ids)
+            return len(self.tombstones) - before
+        # IVF's hashtable direct map only accepts IDSelectorArray for removals
+        return int(index.remove_ids(faiss.IDSelectorArray(ids)))
+
+    def maybe_upgrade(self):
+        """
+        Starts a rebuild when the index has outgrown its current kind, or
+        (same kind) when too many of its vectors are tombstoned.
+        """
+        with self._lock:
+            if self.index is None or self._pending is not None:
+                return
+            current = self.kind.replace("_sq8", "")
+            target = self.target_kind(self.ntotal)
+            if KINDS.index(target) > KINDS.index(current):
+                kind = target
+            elif len(self.tombstones) > self.tombstone_ratio * max(1, self.index.ntotal):
+                kind = current
+            else:
+                return
+            self._pending = []
+            self._pending_removals = []
+
+        if self.background:
+            self._rebuild_thread = threading.Thread(target=self._rebuild, args=(kind,), daemon=True)
+            self._rebuild_thread.start()
+        else:
+            self._rebuild(kind)
+
+    def _rebuild(self, kind: str):
+        try:
+            with self._lock:
+                old_kind = self.kind
+                excluded = set(self.tombstones)
+                ids = stored_ids(self.index)
+                if excluded:
+                    ids = ids[~np.isin(ids, self._tombstone_array())]
+                vectors = self.index.reconstruct_batch(ids)
+
+            # Training and adding happen outside the lock; searches keep using the old index
+            start = time.perf_counter()
+            index = self._build(kind, vectors, ids)
+            seconds = time.perf_counter() - start
+            recall = self._measure_recall(index, vectors, ids)
+
+            with self._lock:
+                for pending_vectors, pending_ids in self._pending:
+                    index.add_with_ids(pending_vectors, pending_ids)
+                # Removals that arrived during the rebuild are re-applied to the new index
+                leftover = (self.tombstones - excluded).union(*(r.tolist() for r in self._pending_removals))
+                self.index = index
+                self.tombstones = set()
+                if leftover:
+                    self._remove_from(index, np.fromiter(leftover, dtype=np.int64, count=len(leftover)))
+
+            self.upgrades.append({
+                "from": old_kind, "to": self.kind, "ntotal": int(len(ids)), "dropped_tombstones": len(excluded),
+                "build_seconds": round(seconds, 2), "recall_at_10": recall
+            })
+            action = "Upgraded" if old_kind != self.kind else "Rebuilt"
+            self.log(f"[index] {action} {old_kind} → {self.kind} at {len(ids)} vectors in {seconds:.1f}s (recall@10 {recall})")
+        except Exception as e:
+            self.log(f"[index] ⚠️ Rebuild to {kind} failed, keeping {self.kind}: {e}")
+        finally:
+            with self._lock:
+                self._pending = None
+                self._pending_removals = []
+
+    def wait(self):
+        """Blocks until a background rebuild (if any) has been swapped in."""
+        if self._rebuild_thread is not None:
+            self._rebuild_thread.join()
+
+    def _measure_recall(self, index, vectors: np.ndarray, ids: np.ndarray, k: int = 10) -> Optional[float]:
+        """recall@k of `index` against exact search, using a sample of stored vectors as queries."""
+        if len(vectors) <= k:
+            return None
+        rng = np.random.default_rng(0)
+        queries = vectors[rng.choice(len(vectors), min(self.recall_sample, len(vectors)), replace=False)]
+        _, exact = faiss.knn(queries, vectors, k, metric=self.faiss_metric)
+        _, found = index.search(queries, k)
+        hits = sum(len(set(ids[row]) & set(found_row)) for row, found_row in zip(exact, found))
+        return round(hits / (len(queries) * k), 3)
+
+    # === Reads ===
+
+    def reconstruct_batch(self, ids: np.ndarray) -> np.ndarray:
+        with self._lock:
+            return self.index.reconstruct_batch(np.asarray(ids, dtype=np.int64))
+
+    def _search_params(self, sel):
+        if isinstance(self.index, faiss.IndexIDMap2):
+            if isinstance(faiss.downcast_index(self.index.index), faiss.IndexHNSW):
+                return faiss.SearchParametersHNSW(sel=sel, efSearch=self.ef_search)
+            return faiss.SearchParameters(sel=sel)
+        return faiss.SearchParametersIVF(sel=sel, nprobe=self.index.nprobe)
+
+    def _exact(self, queries: np.ndarray, k: int, ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        D, I = faiss.knn(queries, self.index.reconstruct_batch(ids), min(k, len(ids)), metric=self.faiss_metric)
+        return D, np.where(I >= 0, ids[I], -1)
+
+    def search(self, queries: np.ndarray, k: int, ids: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Nearest neighbours as (distances or similarities, ids), shaped like faiss' search.
+        `ids` restricts the search to those (live) vector ids: small subsets are scored
+        exactly, larger ones through an IDSelector inside the index.
+        """
+        queries = self._prepare(np.asarray(queries, dtype=np.float32).reshape(-1, self.dim))
+        start = time.perf_counter()
+        with self._lock:
+            if ids is None and self.tombstones:
+                # Everything except the tombstones; both selectors must outlive the search call
+                hidden = faiss.IDSelectorBatch(self._tombstone_array())
+                visible = faiss.IDSelectorNot(hidden)
+                params = self._search_params(visible)
+                D, I = self.index.search(queries, max(1, min(k, self.ntotal)), params=params)
+                if (I < 0).any() and self.ntotal:
+                    # Approximate indexes can come back short once tombstones cut the graph; score the live vectors exactly
+                    self.exact_fallbacks += 1
+                    D, I = self._exact(queries, k, self.ids())
+            elif ids is None:
+                D, I = self.index.search(queries, min(k, self.index.ntotal))
+            else:
+                ids = np.asarray(ids, dtype=np.int64)
+                if self.tombstones:
+                    ids = ids[~np.isin(ids, self._tombstone_array())]
+                if not len(ids):
+                    D, I = np.zeros((len(queries), 0), dtype=np.float32), np.zeros((len(queries), 0), dtype=np.int64)
+                elif len(ids) <= self.subset_exact_limit:
+                    D, I = self._exact(queries, k, ids)
+                else:
+                    params = self._search_params(faiss.IDSelectorBatch(ids))
+                    D, I = self.index.search(queries, min(k, len(ids)), params=params)
+                    if (I < 0).any():
+                        # Approximate indexes can come back short on very selective filters
+                        self.exact_fallbacks += 1
+                        D, I = self._exact(queries, k, ids)
+        self.latencies.append(time.perf_counter() - start)
+        self.searches += 1
+        return D, I
+
+    def stats(self) -> Dict:
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            return round(latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))] * 1000, 3) if latencies else None
+
+        return {
+            "type": self.kind,
+            "metric": self.metric,
+            "ntotal": self.ntotal,
+            "tombstones": len(self.tombstones),
+            "rebuilding": self._pending is not None,
+            "searches": self.searches,
+            "latency_ms_p50": percentile(50),
+            "latency_ms_p95": percentile(95),
+            "exact_fallbacks": self.exact_fallbacks,
+            "recall_at_10": self.upgrades[-1]["recall_at_10"] if self.upgrades else 1.0,
+            "upgrades": self.upgrades,
+        }
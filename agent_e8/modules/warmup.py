@@ -0,0 +1,118 @@
+# modules/warmup.py → Ollama Model Warmup
+# Role: Keeps local Ollama models resident so the first request doesn't pay a cold load.
+
+# Responsibilities:
+
+# Preload configured models at startup (generate or embed)
+
+# Pass keep_alive on every request so Ollama doesn't unload them
+
+# Track per-model load state and cold-start counts from load_duration
+
+# Dependencies:
+
+# requests, config/profiles.yaml
+
+# Used by: agent.py, model_manager.py, memory.py, mcp_server_2.py
+
+# modules/warmup.py
+
+from typing import Callable, Dict, List, Optional
+from pathlib import Path
+import time
+import requests
+import yaml
+
+PROFILE_YAML = Path(__file__).parent.parent / "config" / "profiles.yaml"
+
+
+class OllamaWarmup:
+    def __init__(
+        self,
+        base_url: str = "http://localhost:11434",
+        keep_alive: str = "30m",
+        models: Optional[List[Dict[str, str]]] = None,
+        cold_threshold: float = 0.5,
+        log: Callable[[str], None] = print
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.keep_alive = keep_alive
+        self.models = models or []
+        self.cold_threshold = cold_threshold  # seconds of load_duration that count as a cold start
+        self.load_state: Dict[str, str] = {}  # model → cold | loading | loaded | failed
+        self.cold_starts: Dict[str, int] = {}
+        self.warmup_seconds: Dict[str, float] = {}
+        self.log = log  # stdio MCP servers must log to stderr, not stdout
+
+    @classmethod
+    def from_profile(cls, config_path: Path = PROFILE_YAML) -> "OllamaWarmup":
+        config = yaml.safe_load(Path(config_path).read_text()).get("warmup", {})
+        return cls(
+            base_url=config.get("ollama_url", "http://localhost:11434"),
+            keep_alive=config.get("keep_alive", "30m"),
+            models=config.get("models", []) if config.get("enabled", True) else [],
+            cold_threshold=config.get("cold_threshold", 0.5)
+        )
+
+    def warmup(self, models: Optional[List[Dict[str, str]]] = None):
+        """
+        Loads each model once and pins it with keep_alive.
+        `models` entries look like {"name": "phi4", "kind": "generate"} or kind "embed".
+        """
+        for entry in models if models is not None else self.models:
+            name, kind = entry["name"], entry.get("kind", "generate")
+            self.load_state[name] = "loading"
+            start = time.perf_counter()
+            try:
+                if kind == "embed":
+                    response = requests.post(
+                        f"{self.base_url}/api/embed",
+                        json={"model": name, "input": "warmup", "keep_alive": self.keep_alive}
+                    )
+                else:
+                    # A generate request without a prompt only loads the model
+                    response = requests.post(
+                        f"{self.base_url}/api/generate",
+                        json={"model": name, "keep_alive": self.keep_alive, "stream": False}
+                    )
+                response.raise_for_status()
+                self.record(name, response.json(), during_warmup=True)
+                self.warmup_seconds[name] = round(time.perf_counter() - start, 2)
+                self.log(f"[warmup] {name} ready in {self.warmup_seconds[name]}s (keep_alive={self.keep_alive})")
+            except Exception as e:
+                self.load_state[name] = "failed"
+                self.log(f"[warmup] ⚠️ Could not preload {name}: {e}")
+
+    def record(self, model: str, data: dict, during_warmup: bool = False):
+        """
+        Call with any Ollama response body; a long load_duration means the model was cold.
+        Only loads hit by real requests count as cold starts.
+        """
+        load_seconds = (data.get("load_duration") or 0) / 1e9
+        if load_seconds > self.cold_threshold and not during_warmup:
+            self.cold_starts[model] = self.cold_starts.get(model, 0) + 1
+        self.load_state[model] = "loaded"
+
+    def resident_models(self) -> List[str]:
+        try:
+            response = requests.get(f"{self.base_url}/api/ps", timeout=5)
+            response.raise_for_status()
+            return [m["name"] for m in response.json().get("models", [])]
+        except Exception:
+            return []
+
+    def status(self) -> Dict[str, dict]:
+        resident = self.resident_models()
+        names = set(self.load_state) | set(self.cold_starts)
+        return {
+            name: {
+                "state": self.load_state.get(name, "cold"),
+                "resident": any(r == name or r.split(":")[0] == name for r in resident),
+                "cold_starts": self.cold_starts.get(name, 0),
+                "warmup_seconds": self.warmup_seconds.get(name),
+            }
+            for name in sorted(names)
+        }
+
+
+ollama_warmup = OllamaWarmup.from_profile()
@@ -0,0 +1,6 @@
+# tests/conftest.py → puts the agent root on sys.path, so tests import modules.* and core.* as the agent does
+
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
@@ -0,0 +1,23 @@
+# tests/test_action.py → argument decoding of FUNCTION_CALL lines and structured plans
+
+from modules.action import PlannedAction, parse_function_call
+
+
+def test_function_call_keeps_json_words_as_strings():
+    tool, args = parse_function_call('FUNCTION_CALL: lookup|input.flag=true|input.missing=null|input.obj={"a": true}')
+    assert tool == "lookup"
+    assert args == {"input": {"flag": "true", "missing": "null", "obj": '{"a": true}'}}
+
+
+def test_function_call_decodes_python_literals():
+    _, args = parse_function_call("FUNCTION_CALL: int_list_to_exponential_sum|input.int_list=[73,78,68]|input.n=5|input.s=INDIA")
+    assert args == {"input": {"int_list": [73, 78, 68], "n": 5, "s": "INDIA"}}
+
+
+def test_planned_action_decodes_json_values():
+    plan = PlannedAction(
+        action="function_call",
+        tool_name="lookup",
+        arguments=[{"name": "input.flag", "value": "true"}, {"name": "input.obj", "value": '{"a": null}'}],
+    )
+    assert plan.to_arguments() == {"input": {"flag": True, "obj": {"a": None}}}
@@ -0,0 +1,21 @@
+# tests/test_chunk_store.py → legacy metadata.json import
+
+import json
+
+from modules.chunk_store import ChunkStore
+
+ROWS = [{"doc": "a.md", "chunk_id": "a_0", "chunk": "hello"}, {"doc": "a.md", "chunk_id": "a_1", "chunk": "world"}]
+
+
+def test_import_json_counts_inserted_rows(tmp_path):
+    metadata = tmp_path / "metadata.json"
+    metadata.write_text(json.dumps(ROWS))
+    store = ChunkStore(tmp_path / "metadata.sqlite")
+
+    assert store.import_json(metadata) == 2
+    assert not metadata.exists()
+
+    # A store that already has rows imports nothing, and says so
+    metadata.write_text(json.dumps(ROWS))
+    assert store.import_json(metadata) == 0
+    assert store.count() == 2
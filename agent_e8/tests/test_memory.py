@@ -0,0 +1,55 @@
+# tests/test_memory.py → near-duplicate compaction must not merge results that differ in numbers or ids
+
+import numpy as np
+
+from modules.embedding_cache import EmbeddingCache
+from modules.memory import MemoryItem, MemoryManager, call_key
+
+
+def memory_with_identical_embeddings(tmp_path) -> MemoryManager:
+    """Every text embeds to the same vector, so only the content checks tell items apart."""
+    memory = MemoryManager(
+        "http://localhost:11434/api/embeddings",
+        cache=EmbeddingCache("test:embed", cache_dir=tmp_path / "embeddings"),
+        compaction={"dedupe_threshold": 0.97}
+    )
+    vector = np.random.default_rng(0).random(8, dtype=np.float32)
+    memory._get_embeddings = lambda texts, batch_size=None: np.tile(vector, (len(texts), 1))
+    return memory
+
+
+def tool_output(arguments: dict, result: str) -> MemoryItem:
+    return MemoryItem(
+        text=f"add({arguments}) → {result}", type="tool_output", tool_name="add",
+        call_key=call_key("add", arguments), session_id="s1"
+    )
+
+
+def test_numerically_different_outputs_both_survive(tmp_path):
+    memory = memory_with_identical_embeddings(tmp_path)
+    memory.add(tool_output({"a": 5, "b": 3}, "8"))
+    memory.add(tool_output({"a": 5, "b": 4}, "9"))
+
+    assert sorted(record.text for record in memory.data.values()) == [
+        "add({'a': 5, 'b': 3}) → 8", "add({'a': 5, 'b': 4}) → 9"
+    ]
+    assert memory.find_tool_result("add", {"a": 5, "b": 3})[0] == "8"
+    assert memory.find_tool_result("add", {"a": 5, "b": 4})[0] == "9"
+
+
+def test_different_ids_in_one_batch_both_survive(tmp_path):
+    memory = memory_with_identical_embeddings(tmp_path)
+    memory.bulk_add([
+        MemoryItem(text="Circular NSE/INVG/67564 on Gensol", type="fact"),
+        MemoryItem(text="Circular NSE/INVG/67565 on Gensol", type="fact"),
+    ])
+
+    assert len(memory.data) == 2
+
+
+def test_repeated_output_is_superseded(tmp_path):
+    memory = memory_with_identical_embeddings(tmp_path)
+    memory.add(tool_output({"a": 5, "b": 3}, "8"))
+    memory.add(tool_output({"a": 5, "b": 3}, "8"))
+
+    assert len(memory.data) == 1
@@ -0,0 +1,36 @@
+# tests/test_perception.py → perception degrades to a bare PerceptionResult when the LLM fails
+
+import asyncio
+
+from modules import perception
+from modules.perception import PerceptionResult
+
+
+def failing_model(*args, **kwargs):
+    raise ValueError("reply did not validate against the schema")
+
+
+def test_result_without_intent_is_valid():
+    result = PerceptionResult(user_input="What is 2+2?")
+    assert result.intent is None
+    assert result.entities == []
+    assert result.tool_hint is None
+
+
+def test_structured_failure_falls_back(monkeypatch):
+    monkeypatch.setattr(perception, "STRUCTURED_OUTPUT", True)
+    monkeypatch.setattr(perception.model, "generate_json", failing_model)
+
+    result = asyncio.run(perception.extract_perception("Find the DLF annual report"))
+
+    assert result == PerceptionResult(user_input="Find the DLF annual report")
+
+
+def test_text_failure_falls_back(monkeypatch):
+    monkeypatch.setattr(perception, "STRUCTURED_OUTPUT", False)
+    monkeypatch.setattr(perception.model, "generate_text", failing_model)
+
+    result = asyncio.run(perception.extract_perception("Find the DLF annual report"))
+
+    assert result.user_input == "Find the DLF annual report"
+    assert result.intent is None